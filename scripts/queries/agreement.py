@@ -0,0 +1,98 @@
+import heapq
+from collections import Counter, defaultdict
+
+__all__ = (
+    'agreement',
+    'cohen_kappa',
+    'span_pipeline'
+)
+
+
+def span_pipeline(filters):
+    """
+    Aggregation pipeline streaming the matching annotations as (corpus,
+    doc, start, end, username, value) rows sorted by corpus, document and
+    span start. Token spans cover their scope, IOB spans the inclusive
+    range [B, O].
+    """
+    return [{"$match": filters},
+            {"$project": {"_id": 0, "corpus": 1, "doc": "$span.doc",
+                          "username": 1, "value": "$ann.value",
+                          "start": {"$ifNull": ["$span.scope.B",
+                                               "$span.scope"]},
+                          "end": {"$ifNull": ["$span.scope.O",
+                                             "$span.scope"]}}},
+            {"$sort": {"corpus": 1, "doc": 1, "start": 1}}]
+
+
+def cohen_kappa(confusion):
+    """
+    Cohen's kappa of two annotators given a Counter of (value, value)
+    pairs over the units both annotated.
+    """
+    n = sum(confusion.values())
+    if n == 0:
+        return None
+    observed = sum(c for (a, b), c in confusion.items() if a == b) / n
+    first, second = Counter(), Counter()
+    for (a, b), c in confusion.items():
+        first[a] += c
+        second[b] += c
+    expected = sum(first[v] * second[v] for v in first) / n ** 2
+    if expected == 1:
+        return 1.0
+    return (observed - expected) / (1 - expected)
+
+
+def agreement(rows):
+    """
+    Pairwise agreement between annotators in a single pass over rows sorted
+    by corpus, document and span start (see `span_pipeline`).
+
+    A sweep line keeps the spans of the current document that are still
+    open (a heap by span end), so each span is only compared with the
+    spans overlapping it: O(n log n + overlapping pairs) instead of
+    comparing all pairs. Overlaps follow the span check on insert: spans
+    [B, O] of the same corpus and document overlap if each starts before
+    the other ends. Annotations without a document can't be located and
+    are skipped.
+
+    Returns a row per annotator pair with their annotation counts, the
+    overlapping and exactly matching span pairs, how many exact matches
+    have the same value and Cohen's kappa of the values on exact matches,
+    and the number of skipped annotations.
+    """
+    totals, pairs = Counter(), defaultdict(
+        lambda: {'overlap': 0, 'exact': 0, 'values': Counter()})
+    active, doc, skipped = [], object(), 0
+    for i, row in enumerate(rows):
+        if row.get('start') is None or row.get('doc') is None:
+            skipped += 1
+            continue
+        if (row.get('corpus'), row['doc']) != doc:
+            active, doc = [], (row.get('corpus'), row['doc'])
+        totals[row['username']] += 1
+        while active and active[0][0] < row['start']:
+            heapq.heappop(active)       # ended before this span starts
+        for _, _, other in active:
+            if other['username'] == row['username']:
+                continue
+            a, b = sorted([row, other], key=lambda r: r['username'])
+            stats = pairs[(a['username'], b['username'])]
+            stats['overlap'] += 1
+            if (a['start'], a['end']) == (b['start'], b['end']):
+                stats['exact'] += 1
+                stats['values'][(a.get('value'), b.get('value'))] += 1
+        heapq.heappush(active, (row['end'], i, row))
+
+    result = []
+    for (a, b), stats in sorted(pairs.items()):
+        kappa = cohen_kappa(stats['values'])
+        result.append({'annotators': '{a}/{b}'.format(a=a, b=b),
+                       'count_a': totals[a], 'count_b': totals[b],
+                       'overlap': stats['overlap'], 'exact': stats['exact'],
+                       'same_value': sum(c for (x, y), c in
+                                         stats['values'].items() if x == y),
+                       'kappa': None if kappa is None else
+                       round(kappa, 3)})
+    return result, skipped
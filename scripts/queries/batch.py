@@ -0,0 +1,156 @@
+import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+import writers
+from finder import ParseError
+
+__all__ = (
+    'read_script',
+    'plan_script',
+    'run_script'
+)
+
+# Commands that change the session state instead of producing output
+STATE_COMMANDS = ('filter', 'sort', 'config')
+
+
+def read_script(lines):
+    """Strip comments (#) and blank lines from the lines of a script"""
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if line:
+            yield line
+
+
+def answer_all(res, answer):
+    """Answer the questions of an interactive command with a fixed answer"""
+    if res:
+        for question, callback in res:
+            answer_all(callback(answer), answer)
+
+
+class Job(object):
+    """
+    A script command with a snapshot of the session state at its position
+    in the script. Grouped count jobs with the same filters and projects
+    can be merged into a single $facet aggregation per project.
+    """
+    def __init__(self, text, finder):
+        self.text = text
+        self.finder = finder
+        self.cmd, *self.args = text.split()
+        self.count_args = None
+        if self.cmd == 'count':
+            self.count_args = finder.parse_count_args(list(self.args))
+
+    @property
+    def outfile(self):
+        return self.count_args[2] if self.count_args else None
+
+    def merge_key(self):
+        """Jobs with equal (non None) keys can share an aggregation"""
+        if self.count_args is None or not self.count_args[1]:
+            return None
+        if self.count_args[3]:
+            return None         # approximate counts sample separately
+        if self.finder.config['rollups'] or self.finder.config['union']:
+            return None
+        projects, _, _, _ = self.count_args
+        return json.dumps([self.finder.query_filters(), projects,
+                           self.finder.config], sort_keys=True, default=str)
+
+
+def plan_script(finder, lines, answer='o'):
+    """
+    Replay a script: commands changing the session state (`filter`, `sort`,
+    `config`) are applied to the finder in order (interactive questions
+    get `answer`), other commands become jobs over a fork of the state.
+    Returns a list of lists of jobs, each list sharing one aggregation,
+    and the number of commands that couldn't be parsed.
+    """
+    groups, failures = {}, 0
+    for text in read_script(lines):
+        cmd, *args = text.split()
+        try:
+            assert hasattr(finder, 'do_' + cmd) and cmd != 'exit', \
+                "Unknown command [%s]" % cmd
+            if cmd in STATE_COMMANDS:
+                answer_all(getattr(finder, 'do_' + cmd)(args), answer)
+                continue
+            job = Job(text, finder.fork())
+        except (ParseError, AssertionError, ValueError) as e:
+            report(text, e)
+            failures += 1
+            continue
+        key = job.merge_key() or id(job)
+        groups.setdefault(key, []).append(job)
+    return list(groups.values()), failures
+
+
+def run_group(jobs, answer='o'):
+    """
+    Run a list of jobs, merging the groupby key sets of several count jobs
+    into a single $facet aggregation. Returns the number of failed jobs.
+    """
+    job = jobs[0]
+    if job.count_args is None:
+        answer_all(getattr(job.finder, 'do_' + job.cmd)(job.args), answer)
+        return 0
+    if len(jobs) == 1:
+        return 1 if job.finder.run_count(*job.count_args) else 0
+    projects, _, _, _ = job.count_args
+    groupkey_sets = [keys for j in jobs for keys in j.count_args[1]]
+    by_facet, failed = job.finder.count_facets(projects, groupkey_sets)
+    writers.print_failed(failed)
+    for j in jobs:
+        _, job_sets, outfile, _ = j.count_args
+        j.finder.write_facets(by_facet[:len(job_sets)], job_sets, outfile)
+        by_facet = by_facet[len(job_sets):]
+    return len(jobs) if failed else 0
+
+
+def report(text, e):
+    if isinstance(e, ParseError):
+        print("[{text}] bad input [{value}], expected format is [{expected}]"
+              .format(text=text, value=e.value, expected=e.expected))
+    elif isinstance(e, (AssertionError, ValueError,
+                        pymongo.errors.PyMongoError)):
+        print("[{text}] failed: {e}".format(text=text, e=e))
+    else:
+        print("[{text}] unrecognized error:".format(text=text))
+        print("\t" + traceback.format_exc().replace("\n", "\n\t"))
+
+
+def run_script(finder, lines, jobs=4, answer='o'):
+    """
+    Run a script of CLI commands over one connection. Commands writing to
+    files run concurrently (up to `jobs` at a time), commands printing to
+    stdout run in script order. Returns an exit status: 0 if all commands
+    succeeded, 1 if some failed and 2 if all failed.
+    """
+    groups, failures = plan_script(finder, lines, answer=answer)
+    total = sum(len(group) for group in groups) + failures
+
+    def run(group):
+        try:
+            return run_group(group, answer=answer)
+        except Exception as e:
+            report(" | ".join(job.text for job in group), e)
+            return len(group)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run, group) for group in groups
+                   if all(job.outfile for job in group)]
+        for group in groups:
+            if not all(job.outfile for job in group):
+                failures += run(group)
+        failures += sum(future.result() for future in futures)
+
+    if failures:
+        print("{n} of {total} commands failed".format(n=failures, total=total))
+    if total == 0 or failures == 0:
+        return 0
+    return 2 if failures == total else 1
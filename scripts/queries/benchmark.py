@@ -0,0 +1,202 @@
+"""
+Benchmark the query CLI operations over synthetic annotation collections.
+
+Generates annotation documents following the annotation schema (see
+README.md) into a dedicated database of a local mongod (or an in-process
+mongomock) and times count, groupby and export operations across project
+counts and sizes, with and without indexes. Results are written as a JSON
+report that can be compared across runs:
+
+    python benchmark.py localhost --projects 1,8 --sizes 10000,100000
+    python benchmark.py --mock --sizes 1000 --output report.json
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import platform
+import tempfile
+import statistics
+from datetime import datetime
+from contextlib import redirect_stdout
+
+import pymongo
+
+import writers
+from finder import Finder
+
+
+USERS = ['user%d' % i for i in range(20)]
+CORPORA = ['corpus%d' % i for i in range(5)]
+ANN_KEYS = {'pos': ['N', 'V', 'ADJ', 'ADV', 'PRON', 'DET'],
+            'lemma': ['be', 'have', 'do', 'say', 'go', 'get', 'make'],
+            'sentiment': ['positive', 'negative', 'neutral'],
+            'error': ['spelling', 'grammar', 'style']}
+QUERIES = ['[word="%s"]' % w for w in ('the', 'a', 'house', 'dog', 'run')] + \
+          ['[pos="N.*"][pos="V.*"]', '[lemma="be"] []{0,3} [pos="ADJ"]']
+
+# Indexes created for the "with indexes" runs
+INDEXES = [[('username', 1), ('corpus', 1)],
+           [('ann.key', 1), ('username', 1)],
+           [('timestamp', -1)]]
+
+
+def generate_annotation(rng, start, span=3600 * 24 * 365 * 1000):
+    """Random annotation document following the annotation schema"""
+    ann_key = rng.choice(list(ANN_KEYS))
+    B = rng.randint(0, 1000000)
+    if rng.random() < 0.7:
+        span_doc = {'type': 'token', 'scope': B}
+    else:
+        O = B + rng.randint(1, 5)
+        span_doc = {'type': 'IOB', 'scope': {'B': B, 'O': O}}
+    if rng.random() < 0.5:
+        span_doc['doc'] = 'doc%d' % rng.randint(0, 1000)
+    doc = {'_id': str(uuid.UUID(int=rng.getrandbits(128))),
+           'ann': {'key': ann_key, 'value': rng.choice(ANN_KEYS[ann_key])},
+           'span': span_doc,
+           'username': rng.choice(USERS),
+           'corpus': rng.choice(CORPORA),
+           'timestamp': start + rng.randint(0, span),
+           'hit-id': '%d.%d' % (rng.randint(0, 100), rng.randint(0, 1000)),
+           '_version': rng.choice([0, 0, 0, 1, 2])}
+    if rng.random() < 0.9:      # review annotations don't have query
+        doc['query'] = rng.choice(QUERIES)
+    return doc
+
+
+def generate_project(coll, size, rng, start, batch_size=10000):
+    done = 0
+    while done < size:
+        n = min(batch_size, size - done)
+        coll.insert_many([generate_annotation(rng, start) for _ in range(n)])
+        done += n
+
+
+def timeit(fn, repeat):
+    timings = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+    return {'min': min(timings), 'median': statistics.median(timings),
+            'max': max(timings)}
+
+
+def operations(finder, outdir):
+    """Dict from operation name to a thunk running it over all projects"""
+    def count():
+        finder.count_projects(finder.get_project_names())
+
+    def count_filtered():
+        finder.filters['username'] = [USERS[0]]
+        try:
+            finder.count_projects(finder.get_project_names())
+        finally:
+            del finder.filters['username']
+
+    def groupby():
+        finder.count_projects(finder.get_project_names(),
+                              ['username', 'corpus'])
+
+    def export_counts():
+        groupkeys = ['username', 'corpus', 'ann.key']
+        by_project, _ = finder.count_projects(
+            finder.get_project_names(), groupkeys)
+        writers.write_count_group(
+            by_project, groupkeys, os.path.join(outdir, 'counts.csv'), 'csv')
+
+    def export_annotations():
+        for project_name in finder.get_project_names():
+            finder.export_annotations(
+                project_name, ['username', 'corpus', 'ann.key', 'ann.value'],
+                os.path.join(outdir, project_name + '.jsonl'))
+
+    return {'count': count, 'count_filtered': count_filtered,
+            'groupby': groupby, 'export_counts': export_counts,
+            'export_annotations': export_annotations}
+
+
+def run(finder, projects, sizes, repeat, seed, outdir, with_indexes=True):
+    rng = random.Random(seed)
+    start = int(datetime(2016, 1, 1).timestamp() * 1000)
+    runs = []
+    for n_projects in projects:
+        for size in sizes:
+            for coll_name in finder.get_coll_names():
+                finder.conn.drop_collection(coll_name)
+            for i in range(n_projects):
+                generate_project(finder.get_project('bench%d' % i),
+                                 size, rng, start)
+            for indexed in ([False, True] if with_indexes else [False]):
+                for project in finder.get_projects():
+                    if indexed:
+                        for keys in INDEXES:
+                            project.create_index(keys)
+                    else:
+                        project.drop_indexes()
+                for name, fn in operations(finder, outdir).items():
+                    timing = timeit(fn, repeat)
+                    runs.append(dict(operation=name, projects=n_projects,
+                                     size=size, indexes=indexed, **timing))
+                    print("{op:20} projects={p:<4} size={s:<9} indexes={i:<2}"
+                          " median={t:.4f}s".format(
+                              op=name, p=n_projects, s=size, i=int(indexed),
+                              t=timing['median']))
+    return runs
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Cosycat Query benchmarks')
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=27017)
+    parser.add_argument('-d', '--db', type=str, default='cosycat_benchmark')
+    parser.add_argument('-m', '--mock', default=False, action='store_true',
+                        help="Use an in-process mongomock instead of mongod")
+    parser.add_argument('--projects', default='1,4',
+                        help="Comma-separated numbers of projects")
+    parser.add_argument('--sizes', default='1000,10000',
+                        help="Comma-separated annotations per project")
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-s', '--seed', type=int, default=1001)
+    parser.add_argument('--no_indexes', default=False, action='store_true')
+    parser.add_argument('--keep', default=False, action='store_true',
+                        help="Don't drop the benchmark database afterwards")
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    assert args.db != 'cosycat', "Refusing to run on the cosycat database"
+    if args.mock:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        client = pymongo.MongoClient(args.host, args.port)
+    finder = Finder(None, args.db, verbose=False, client=client,
+                    config={'workers': args.workers})
+
+    with tempfile.TemporaryDirectory() as outdir:
+        runs = run(finder,
+                   [int(p) for p in args.projects.split(',')],
+                   [int(s) for s in args.sizes.split(',')],
+                   args.repeat, args.seed, outdir,
+                   with_indexes=not args.no_indexes)
+    if not args.keep:
+        client.drop_database(args.db)
+
+    report = {'date': datetime.now().isoformat(),
+              'backend': 'mongomock' if args.mock else
+              'mongod ' + client.server_info()['version'],
+              'python': platform.python_version(),
+              'pymongo': pymongo.version,
+              'workers': args.workers,
+              'seed': args.seed,
+              'repeat': args.repeat,
+              'runs': runs}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Wrote report to {output}".format(output=args.output))
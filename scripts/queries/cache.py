@@ -0,0 +1,110 @@
+import json
+import time
+import shelve
+import threading
+from collections import OrderedDict
+
+import pymongo
+
+__all__ = (
+    'ResultCache',
+    'query_key',
+    'collection_signal'
+)
+
+
+def query_key(coll_name, filters, groupkeys=None, scope=None):
+    """
+    Serialize a query into a cache key. Filters are normalized by sorting
+    their keys, so that equivalent filter sets map to the same entry.
+    `scope` tells apart databases sharing a (persistent) cache, e.g.
+    `Finder.cache_scope`.
+    """
+    return json.dumps([scope, coll_name,
+                       json.dumps(filters, sort_keys=True, default=str),
+                       list(groupkeys or [])])
+
+
+def collection_signal(coll):
+    """
+    Cheap signal of changes in a collection: its document count (changes on
+    insert and remove) and the highest `timestamp` (changes on insert and
+    update). The latter is only read if `timestamp` is indexed (a single
+    index lookup instead of a collection scan); otherwise updates only show
+    once cached results expire.
+    """
+    last = None
+    if any(info['key'][0][0] == 'timestamp'
+           for info in coll.index_information().values()):
+        last = coll.find_one(projection={'timestamp': 1, '_id': 0},
+                             sort=[('timestamp', pymongo.DESCENDING)])
+    return [coll.estimated_document_count(), (last or {}).get('timestamp')]
+
+
+class ResultCache(object):
+    """
+    LRU cache with time-to-live for query results.
+    Each entry stores the signal of the collection at the time the result
+    was computed; a lookup with a different signal is an invalidation.
+
+    :param size: maximum number of entries before evicting the least
+        recently used one.
+    :param ttl: seconds after which an entry expires.
+    :param path: Optional, shelve file in which entries are persisted across
+        sessions.
+    """
+    def __init__(self, size=256, ttl=3600, path=None):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0, 'expired': 0}
+        self.shelf = None
+        if path is not None:
+            self.shelf = shelve.open(path)
+            for key, entry in sorted(self.shelf.items(),
+                                     key=lambda item: item[1][1]):
+                self.entries[key] = entry
+
+    def _remove(self, key):
+        del self.entries[key]
+        if self.shelf is not None:
+            del self.shelf[key]
+
+    def get(self, key, signal):
+        """Return the cached value for key or None if missing or stale"""
+        with self.lock:
+            if key not in self.entries:
+                self.stats['misses'] += 1
+                return None
+            entry_signal, created, value = self.entries[key]
+            if time.time() - created > self.ttl:
+                self.stats['expired'] += 1
+            elif entry_signal != signal:
+                self.stats['invalidated'] += 1
+            else:
+                self.stats['hits'] += 1
+                self.entries.move_to_end(key)
+                return value
+            self.stats['misses'] += 1
+            self._remove(key)
+            return None
+
+    def put(self, key, signal, value):
+        with self.lock:
+            entry = (signal, time.time(), value)
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if self.shelf is not None:
+                self.shelf[key] = entry
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+    def close(self):
+        if self.shelf is not None:
+            self.shelf.close()
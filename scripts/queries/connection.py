@@ -0,0 +1,178 @@
+import re
+import time
+import random
+import threading
+from collections import defaultdict
+
+import pymongo
+from pymongo import monitoring, ReadPreference
+
+__all__ = (
+    'PoolMonitor',
+    'ReadMode',
+    'client_options',
+    'read_preference',
+    'retry',
+    'uri_hosts'
+)
+
+# Read preference modes by the names used in connection strings
+READ_PREFERENCES = {'primary': ReadPreference.PRIMARY,
+                    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+                    'secondary': ReadPreference.SECONDARY,
+                    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+                    'nearest': ReadPreference.NEAREST}
+
+# Errors after which a read can be sent again: network errors, failovers
+# (NotPrimary) and server selection timeouts are all AutoReconnect
+RETRYABLE_ERRORS = (pymongo.errors.AutoReconnect,)
+
+
+class ReadMode(str):
+    """Name of a read preference mode, checked on creation (for CONFIG)"""
+    def __new__(cls, value):
+        assert value in READ_PREFERENCES, "Specify one of {modes}".format(
+            modes=tuple(READ_PREFERENCES))
+        return super(ReadMode, cls).__new__(cls, value)
+
+
+def read_preference(name):
+    return READ_PREFERENCES[ReadMode(name)]
+
+
+def uri_hosts(uri):
+    """Scheme and hosts of a connection string, without credentials"""
+    if uri is None:
+        return None
+    match = re.match(r"([^:]+://)(?:[^@/]*@)?([^/?]*)", uri)
+    return ''.join(match.groups()) if match else uri
+
+
+def client_options(max_pool_size=None, server_selection_timeout=None,
+                   socket_timeout=None, connect_timeout=None,
+                   read_preference=None):
+    """
+    MongoClient keyword arguments for the given pool size, timeouts (in
+    seconds) and read preference name. Unset values keep pymongo defaults.
+    """
+    options = {}
+    if max_pool_size is not None:
+        options['maxPoolSize'] = max_pool_size
+    timeouts = {'serverSelectionTimeoutMS': server_selection_timeout,
+                'socketTimeoutMS': socket_timeout,
+                'connectTimeoutMS': connect_timeout}
+    for name, seconds in timeouts.items():
+        if seconds is not None:
+            options[name] = int(seconds * 1000)
+    if read_preference is not None:
+        options['readPreference'] = ReadMode(read_preference)
+    return options
+
+
+def retry(fn, retries=3, delay=0.5, max_delay=10, on_retry=None,
+          sleep=time.sleep):
+    """
+    Call `fn` until it doesn't fail with a connection error, at most
+    `retries` more times, waiting a random time up to an exponentially
+    growing bound between attempts ("full jitter", so that concurrent
+    retries spread out). `fn` must be idempotent, i.e. a read.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except RETRYABLE_ERRORS as e:
+            if attempt >= retries:
+                raise
+            wait = random.uniform(0, min(max_delay, delay * 2 ** attempt))
+            if on_retry is not None:
+                on_retry(e, attempt + 1, wait)
+            sleep(wait)
+            attempt += 1
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener,
+                  monitoring.ServerHeartbeatListener):
+    """
+    Connection pool health fed by pymongo's pool and heartbeat events:
+    connections open and in use per server, checkout failures, pool
+    clears (after network errors or failovers), failed heartbeats and the
+    last error seen. Retries of reads are counted by the caller.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_server = defaultdict(lambda: defaultdict(int))
+        self.last_error = {}
+        self.retries = 0
+
+    def _incr(self, address, stat, n=1):
+        with self.lock:
+            self.by_server['%s:%s' % address][stat] += n
+
+    # pymongo.monitoring.ConnectionPoolListener
+
+    def pool_created(self, event):
+        self._incr(event.address, 'open', 0)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._incr(event.address, 'cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr(event.address, 'open')
+        self._incr(event.address, 'created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr(event.address, 'open', -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._incr(event.address, 'checkout_failed')
+        with self.lock:
+            self.last_error['%s:%s' % event.address] = str(event.reason)
+
+    def connection_checked_out(self, event):
+        self._incr(event.address, 'in_use')
+
+    def connection_checked_in(self, event):
+        self._incr(event.address, 'in_use', -1)
+
+    # pymongo.monitoring.ServerHeartbeatListener
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        self._incr(event.connection_id, 'heartbeat_failed')
+        with self.lock:
+            self.last_error['%s:%s' % event.connection_id] = str(event.reply)
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def stats(self):
+        """A row per server with its pool counters and last error"""
+        rows = []
+        with self.lock:
+            for server, stats in sorted(self.by_server.items()):
+                row = {'server': server}
+                for stat in ('open', 'in_use', 'created', 'cleared',
+                             'checkout_failed', 'heartbeat_failed'):
+                    row[stat] = stats[stat]
+                row['last_error'] = self.last_error.get(server, '')
+                rows.append(row)
+        return rows
@@ -0,0 +1,103 @@
+import pymongo
+
+__all__ = (
+    'find_key',
+    'plan_summary',
+    'suggest_index',
+    'has_index'
+)
+
+# Plan stages that read from an index instead of scanning the collection
+INDEX_STAGES = ('IXSCAN', 'COUNT_SCAN', 'DISTINCT_SCAN', 'IDHACK')
+
+
+def find_key(doc, key):
+    """
+    Recursively yield all values of `key` in a nested structure of dicts
+    and lists (explain output differs across server versions and engines).
+    """
+    if isinstance(doc, dict):
+        for k, v in doc.items():
+            if k == key:
+                yield v
+            else:
+                yield from find_key(v, key)
+    elif isinstance(doc, list):
+        for v in doc:
+            yield from find_key(v, key)
+
+
+def plan_stages(plan):
+    """Flatten a (possibly nested) winning plan into a list of stages"""
+    stages = []
+    for stage in find_key(plan, 'stage'):
+        if isinstance(stage, str):
+            stages.append(stage)
+    return stages
+
+
+def plan_summary(explain):
+    """
+    Summarize the output of an `explain` command in executionStats mode.
+    Returns a dict with the access `plan` (IXSCAN, COLLSCAN, ...), the
+    `index` used (if any) and the examined/returned document counts.
+    """
+    stages, index_names = [], []
+    for plan in find_key(explain, 'winningPlan'):
+        stages.extend(plan_stages(plan))
+        index_names.extend(find_key(plan, 'indexName'))
+    access = [s for s in stages if s in INDEX_STAGES or s == 'COLLSCAN']
+    summary = {'plan': access[-1] if access else (stages or ['?'])[-1],
+               'index': index_names[0] if index_names else '',
+               'docsExamined': 0, 'keysExamined': 0, 'nReturned': 0}
+    for stats in find_key(explain, 'executionStats'):
+        summary['docsExamined'] += stats.get('totalDocsExamined', 0)
+        summary['keysExamined'] += stats.get('totalKeysExamined', 0)
+        summary['nReturned'] += stats.get('nReturned', 0)
+    return summary
+
+
+def is_range_filter(value):
+    return isinstance(value, dict) and '$in' not in value
+
+
+def suggest_index(filters, sort=(), groupkeys=()):
+    """
+    Suggest a compound index for a query following the equality-sort-range
+    rule: equality filters first, then sort keys, then range filters (e.g.
+    regexes). Groupby keys are appended so that the $group can be covered.
+    Returns a list of (key, direction) pairs.
+    """
+    keys = []
+
+    def add(key, direction=pymongo.ASCENDING):
+        if key not in [k for k, _ in keys]:
+            keys.append((key, direction))
+
+    # top-level operators ($and of text index clauses) aren't fields
+    filters = {k: v for k, v in filters.items() if not k.startswith('$')}
+    for key, value in filters.items():
+        if not is_range_filter(value):
+            add(key)
+    for key, direction in sort:
+        add(key, direction)
+    for key, value in filters.items():
+        if is_range_filter(value):
+            add(key)
+    for key in groupkeys:
+        add(key)
+    return keys
+
+
+def has_index(index_information, keys):
+    """True if an existing (non-partial) index has `keys` as its prefix"""
+    def normalize(direction):
+        return int(direction) if isinstance(direction, float) else direction
+
+    for info in index_information.values():
+        if info.get('sparse') or 'partialFilterExpression' in info:
+            continue
+        index_keys = [(k, normalize(d)) for k, d in info['key']]
+        if index_keys[:len(keys)] == list(keys):
+            return True
+    return False
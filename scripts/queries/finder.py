@@ -1,15 +1,31 @@
 
 import re
 import sys
+import copy
 import time
+import uuid
 import inspect
+import threading
 from pprint import pprint
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import pymongo
 from pymongo import MongoClient
 
 import writers
+import explain
+import cache
+import rollups
+import rawbson
+import sketches
+import timeline
+import snapshot
+import agreement
+import textindex
+import watch
+import connection
+import monitoring
 
 
 class ParseError(Exception):
@@ -19,8 +35,130 @@ class ParseError(Exception):
         self.expected = expected
 
 
+class QueryCancelled(Exception):
+    pass
+
+
+# Session configuration: name -> (type, default value, description)
+CONFIG = {
+    'workers': (int, 1, "number of projects queried concurrently"),
+    'project_timeout': (float, None, "seconds before a project query aborts"),
+    'union': (bool, False, "count all projects in a single $unionWith query"),
+    'page_size': (int, 10, "annotations shown per page by find/next"),
+    'cache': (bool, False, "reuse results of unchanged collections"),
+    'cache_size': (int, 256, "maximum number of cached results"),
+    'cache_ttl': (float, 3600, "seconds before a cached result expires"),
+    'rollups': (bool, False, "answer counts from incremental rollups"),
+    'rollup_refresh': (float, 60, "seconds between rollup refreshes by count"),
+    'slow_threshold': (float, 1.0, "seconds above which commands are logged"),
+    'explain_slow': (bool, False, "re-run slow queries with explain"),
+    'text_index': (bool, False, "narrow regex filters with the trigram index"),
+    'retries': (int, 3, "retries of a read after a connection error"),
+    'retry_delay': (float, 0.5, "seconds before the first retry (doubles)"),
+    'read_preference': (connection.ReadMode, None,
+                        "read preference of project queries"),
+    'partitions': (int, 1, "_id ranges of a project grouped concurrently"),
+    'check_partitions': (bool, False, "compare partitioned and single counts")
+}
+
+# Documents fetched per round trip when exporting annotations
+EXPORT_BATCH_SIZE = 1000
+
+# Annotation fields shown by find unless others are requested
+DISPLAY_FIELDS = ('timestamp', 'username', 'corpus', 'ann.key', 'ann.value')
+
+# MongoDB error code for unknown aggregation stages
+UNRECOGNIZED_STAGE = 40324
+
+# Tag field added to documents by cross-project ($unionWith) pipelines
+PROJECT_TAG = '__project'
+
+# HyperLogLog precision of `distinct` (2^14 registers, ~0.8% error)
+DISTINCT_PRECISION = 14
+
+# Fraction of a collection above which $sample reads the whole collection
+SAMPLE_SCAN_FRACTION = 0.05
+
+# Sampled _id's per partition when splitting a project into _id ranges
+PARTITION_SAMPLES = 100
+
+# Seconds for which completion reuses the values of an unindexed field,
+# read by a collection scan limited to UNINDEXED_VALUES_TIMEOUT seconds
+UNINDEXED_VALUES_TTL = 24 * 3600
+UNINDEXED_VALUES_TIMEOUT = 10
+
+
 def get_extension(filename):
-    return filename.split('.')[-1]
+    """Output format of a filename, ignoring a trailing `.gz`"""
+    parts = filename.split('.')
+    if len(parts) > 2 and parts[-1] == 'gz':
+        return parts[-2]
+    return parts[-1]
+
+
+def is_compressed(filename):
+    return filename.endswith('.gz')
+
+
+def facet_filename(filename, groupkeys):
+    """Insert the groupby keys before the extension: out.csv.gz ->
+    out.username-corpus.csv.gz"""
+    ext = get_extension(filename)
+    stem, _, suffix = filename.rpartition('.' + ext)
+    return '{stem}.{keys}.{ext}{suffix}'.format(
+        stem=stem, keys='-'.join(groupkeys), ext=ext, suffix=suffix)
+
+
+def group_key(row):
+    """Hashable groupby keys of a counts row"""
+    return tuple(sorted((k, repr(v)) for (k, v) in row.items()
+                        if k != 'count'))
+
+
+def merge_group_rows(partials):
+    """Sum the counts of rows with equal groupby keys over partial results"""
+    merged = {}
+    for rows in partials:
+        for row in rows:
+            key = group_key(row)
+            if key in merged:
+                merged[key]['count'] += row['count']
+            else:
+                merged[key] = dict(row)
+    return list(merged.values())
+
+
+def parse_config_value(key, value):
+    """Cast a user-given config value to the type declared in CONFIG"""
+    assert key in CONFIG, "Specify one of {keys}".format(keys=tuple(CONFIG))
+    value_type, default, _ = CONFIG[key]
+    if value.lower() == 'none':
+        if default is not None:
+            raise ValueError("{key} can't be unset".format(key=key))
+        return None
+    if value_type is bool:
+        assert value.lower() in ('on', 'off'), "Specify one of (on, off)"
+        return value.lower() == 'on'
+    try:
+        return value_type(value)
+    except ValueError:
+        raise ValueError("{key} must be of type {t}".format(
+            key=key, t=value_type.__name__))
+
+
+def keyset_filter(sort, last):
+    """
+    Build a query selecting the documents that come after `last` (a dict
+    from sort key to value) in the order given by `sort`, a pymongo sort
+    list. This allows resuming a sorted scan without skipping documents.
+    """
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        op = "$gt" if direction == pymongo.ASCENDING else "$lt"
+        clause = {k: last[k] for (k, _) in sort[:i]}
+        clause[key] = {op: last[key]}
+        clauses.append(clause)
+    return {"$or": clauses}
 
 
 def parse_rest(rest, schema):
@@ -52,18 +190,51 @@ def parse_rest(rest, schema):
 
 
 class Finder(object):
-    def __init__(self, uri, db, verbose=True, timeout=3, **kwargs):
+    # Commands that may run in the background in asynchronous mode
+    BACKGROUND_COMMANDS = ('count', 'projects', 'rollup', 'distinct',
+                           'timeline', 'textindex', 'snapshot',
+                           'agreement', 'watch')
+    # Background commands that run until cancelled, each on its own thread
+    # rather than holding up the queued commands
+    DETACHED_COMMANDS = ('watch',)
+    # Position of the project argument of commands, for completion
+    PROJECT_ARGS = {'count': 1, 'find': 1, 'indexes': 1, 'timeline': 1,
+                    'distinct': 1, 'agreement': 1, 'rollup': 2,
+                    'watch': 1, 'textindex': 2, 'snapshot': 2}
+
+    def __init__(self, uri, db, verbose=True, timeout=3, config=None,
+                 cache_file=None, rollup_file=None, textindex_file=None,
+                 snapshot_dir=None, slow_log=None, client=None, **kwargs):
         self.uri = uri
+        self.db = db
         self.verbose = verbose
         self.timeout = timeout
-        try:
-            self.conn = MongoClient(self.uri, **kwargs)[db]
-            print("Connected to {conn}".format(conn=self.conn))
-        except pymongo.errors.ConnectionFailure as e:
-            print("Couldn't connect to MongoDB: {e}".format(e=e))
+        self.monitor = monitoring.QueryMonitor(slow_log=slow_log)
+        self.pool = connection.PoolMonitor()
+        # MongoClient options, e.g. from connection.client_options
+        self.client_options = dict(kwargs)
+        self.client_options.setdefault(
+            'serverSelectionTimeoutMS', int(timeout * 1000))
+        self.connect(client)
         self.filters = defaultdict(list)
         self.sort_props = {}
-        self.config = {}
+        self._server_version = None
+        self.browser = None     # state of the last `find`
+        self.comment = None     # tag of the server operations of the session
+        self.cancelled = threading.Event()
+        self.progress = {'done': 0, 'total': 0, 'rows': 0}
+        self.config = {key: default for key, (_, default, _) in CONFIG.items()}
+        self.config.update(config or {})
+        self.cache = cache.ResultCache(
+            size=self.config['cache_size'], ttl=self.config['cache_ttl'],
+            path=cache_file)
+        self.rollups = rollups.Rollups(path=rollup_file or ':memory:')
+        self.unindexed_warned = set()   # projects warned about timestamp
+        self.scanned_values = {}    # (collection, field) -> (time, values)
+        self.textindex = textindex.TrigramIndex(
+            path=textindex_file or ':memory:')
+        self.snapshot_dir = snapshot_dir
+        self.apply_config()
 
     def _get_suggestions(self, cmd):
         return [method[len('do_'):]
@@ -79,8 +250,40 @@ class Finder(object):
         for sugg in suggs:
             print("    " + sugg)
 
+    def connect(self, client=None):
+        """
+        Connect to the database. A ready client (e.g. mongomock's) may be
+        passed instead of using the uri and client options of the session.
+        """
+        try:
+            client = client or MongoClient(
+                self.uri, event_listeners=[self.monitor, self.pool],
+                **self.client_options)
+            self.conn = client[self.db]
+            print("Connected to {conn}".format(conn=self.conn))
+        except pymongo.errors.ConnectionFailure as e:
+            print("Couldn't connect to MongoDB: {e}".format(e=e))
+        self._server_version = None
+
+    def retrying(self, fn):
+        """Run a read (`fn`), retrying it after connection errors"""
+        def on_retry(e, attempt, wait):
+            self.pool.record_retry()
+            print("Connection error ({e}), retry {n} of {retries} in "
+                  "{wait:.1f}s".format(e=e, n=attempt, wait=wait,
+                                       retries=self.config['retries']))
+
+        return connection.retry(
+            fn, retries=self.config['retries'],
+            delay=self.config['retry_delay'], on_retry=on_retry)
+
     def query_filters(self):
-        """Parse currently stored filter values into a pymongo query dict"""
+        """
+        Parse currently stored filter values into a pymongo query dict.
+        Regexes with a literal prefix (`/^prefix/`) become index-friendly
+        ranges. With config `text_index` on, other regexes on indexed fields
+        are narrowed to the matching values found by the trigram index.
+        """
         def filter_value(val):
             if len(val) == 1:
                 filter_val = val[0]
@@ -91,10 +294,138 @@ class Finder(object):
                     return filter_val
             if len(val) > 1:
                 return {"$in": val}
-        return {f: filter_value(val) for (f, val) in self.filters.items()}
+
+        filters, clauses = {}, []
+        for (f, val) in self.filters.items():
+            value = filter_value(val)
+            if isinstance(value, dict) and "$regex" in value:
+                pattern = value["$regex"]
+                prefix = textindex.prefix_filter(pattern)
+                if prefix is not None:
+                    value = prefix
+                else:
+                    clause = self.text_clause(f, pattern)
+                    if clause is not None:
+                        clauses.append(clause)
+                        continue
+            filters[f] = value
+        if clauses:
+            filters["$and"] = clauses
+        return filters
+
+    def text_clause(self, key, pattern):
+        """
+        Filter for the annotations whose `key` matches a regex, through the
+        trigram index: the indexed matching values, plus a regex over the
+        annotations written since the index was built. Returns None if the
+        index can't answer (disabled, projects not indexed, too many values).
+        """
+        if not self.config['text_index']:
+            return None
+        built_at = self.textindex.built_at(key, self.get_project_names())
+        if built_at is None:
+            return None
+        values = self.textindex.candidates(key, pattern)
+        if values is None:
+            return None
+        return {"$or": [{key: {"$in": values}},
+                        {"timestamp": {"$gte": built_at},
+                         key: {"$regex": pattern}}]}
+
+    def apply_config(self):
+        """Propagate configuration values to the session components"""
+        self.cache.size = self.config['cache_size']
+        self.cache.ttl = self.config['cache_ttl']
+        self.monitor.slow_threshold = self.config['slow_threshold']
+
+    def server_version(self):
+        """Return the (major, minor) version of the MongoDB server"""
+        if self._server_version is None:
+            version = self.conn.client.server_info()['versionArray']
+            self._server_version = tuple(version[:2])
+        return self._server_version
+
+    def query_options(self):
+        """Extra keyword arguments for pymongo read operations"""
+        options = {}
+        if self.comment is not None:
+            options['comment'] = self.comment
+        if self.config['project_timeout'] is not None:
+            options['maxTimeMS'] = int(self.config['project_timeout'] * 1000)
+        return options
+
+    def fork(self, tag=False):
+        """
+        Copy of the session sharing connection, cache and rollups, but with
+        its own filters, sort criteria, config and progress. With `tag`, its
+        server-side operations carry a comment, so that `cancel` can kill
+        them (comments on all read commands require MongoDB 4.4).
+        """
+        forked = copy.copy(self)
+        forked.filters = defaultdict(
+            list, {k: list(v) for (k, v) in self.filters.items()})
+        forked.sort_props = dict(self.sort_props)
+        forked.config = dict(self.config)
+        forked.browser = None
+        forked.comment = None
+        if tag and self.server_version() >= (4, 4):
+            forked.comment = 'cosycat-cli-' + uuid.uuid4().hex
+        forked.cancelled = threading.Event()
+        forked.progress = {'done': 0, 'total': 0, 'rows': 0}
+        return forked
+
+    def cancel(self):
+        """Stop running queries of the session and kill their operations"""
+        self.cancelled.set()
+        if self.comment is None:
+            return
+        admin = self.conn.client.admin
+        try:
+            ops = list(admin.aggregate(
+                [{"$currentOp": {}},
+                 {"$match": {"$or": [
+                     {"command.comment": self.comment},
+                     {"cursor.originatingCommand.comment": self.comment}]}}]))
+        except pymongo.errors.PyMongoError as e:
+            # e.g. not authorized to list operations: queries stop on
+            # their next batch, but their server operations run on
+            print("Couldn't kill the server operations: {e}".format(e=e))
+            return
+        for op in ops:
+            try:
+                admin.command('killOp', op=op['opid'])
+            except pymongo.errors.OperationFailure:
+                pass            # operation already finished
+
+    def explain_calls(self, calls):
+        """Add execution stats to recorded aggregate and find calls"""
+        for call in calls:
+            if call['command'] == 'aggregate' and call['pipeline']:
+                cmd = {'aggregate': call['coll'], 'pipeline': call['pipeline'],
+                       'cursor': {}}
+            elif call['command'] == 'find':
+                cmd = {'find': call['coll'], 'filter': call['filter'] or {}}
+            else:
+                continue
+            try:
+                result = self.conn.command(
+                    'explain', cmd, verbosity='executionStats')
+            except pymongo.errors.OperationFailure:
+                continue
+            call.update(explain.plan_summary(result))
+            call['server_ms'] = sum(
+                explain.find_key(result, 'executionTimeMillis'))
+
+    def record_command(self, text):
+        summary = self.monitor.end(text)
+        if self.monitor.is_slow(summary):
+            if self.config['explain_slow']:
+                self.explain_calls(summary['calls'])
+            self.monitor.log_slow(summary)
 
     def parse(self, text):
         cmd, *args = text.split()  # this is python3 only (I think)
+        self.monitor.begin()
         try:
             method = getattr(self, "do_" + cmd)
             return method(args)
@@ -104,16 +435,27 @@ class Finder(object):
             return
 
         except pymongo.errors.AutoReconnect as e:
-            print("Reconnecting... in %d seconds" % self.timeout)
-            time.sleep(self.timeout)
+            # reads have been retried (see config `retries`) by now
+            print("Lost connection to MongoDB ({e}), [{text}] didn't "
+                  "complete. Run it again or `reconnect`".format(
+                      e=e, text=text))
             return
         # AutoReconnect is a subclass of ConnectionFailure
         except pymongo.errors.ConnectionFailure as e:
             print("MongoDB Exception {te}: {e}".format(te=type(e), e=e))
 
+        finally:
+            self.record_command(text)
+
     def add_sort(self, prop, order='des'):
         self.sort_props[prop] = order
 
+    def sort_spec(self):
+        """Parse currently stored sort criteria into a pymongo sort list"""
+        orders = {'asc': pymongo.ASCENDING, 'des': pymongo.DESCENDING}
+        return [(prop, orders[order])
+                for (prop, order) in self.sort_props.items()]
+
     def clear_sort_props(self):
         self.sort_props = {}
 
@@ -163,10 +505,21 @@ class Finder(object):
         """
         Show the current value of a particular settings (e.g. filters).
         """
-        vals = ('filters', 'sort')
+        vals = ('filters', 'sort', 'config', 'cache', 'pool')
         assert len(args) == 1, "Specify at least one value"
         assert args[0] in vals, "Specify one of {vals}".format(vals=vals)
-        if args[0] == 'filters':
+        if args[0] == 'config':
+            self.do_config([])
+        elif args[0] == 'pool':
+            writers.print_table(self.pool.stats(), "Connection pools")
+            for option, value in sorted(self.client_options.items()):
+                print('    {o} => {v}'.format(o=option, v=value))
+            print('    retried reads => {n}'.format(n=self.pool.retries))
+        elif args[0] == 'cache':
+            print('    entries => {n}'.format(n=len(self.cache.entries)))
+            for stat, value in self.cache.stats.items():
+                print('    {s} => {v}'.format(s=stat, v=value))
+        elif args[0] == 'filters':
             for f in self.filters:
                 fs = ', '.join(self.filters[f])
                 print('    {f} => {fs}'.format(f=f, fs=fs))
@@ -241,25 +594,59 @@ class Finder(object):
     def do_reconnect(self, args):
         """
         Refresh MongoClient connection.
+        Closes all pooled connections and connects again, e.g. after a
+        failover. Check the pools with `show pool`.
         """
-        raise pymongo.errors.AutoReconnect()
+        if self.uri is None:
+            print("The session was given a client, can't reconnect it")
+            return
+        self.conn.client.close()
+        self.connect()
 
     def do_config(self, args):
         """
-        Not implemented yet
         Change session configuration.
-          Values:
-            page_size: type int, default 10
+        Input a key and a value to change a setting (`none` unsets those
+        without a default, e.g. project_timeout):
+          config workers 8
+        Input no arguments to show the current configuration:
+          config
         """
-        raise NotImplementedError()
+        if not args:
+            for key, (value_type, default, descr) in sorted(CONFIG.items()):
+                print('    {k} => {v} ({t}, default {d}: {descr})'.format(
+                    k=key, v=self.config[key], t=value_type.__name__,
+                    d=default, descr=descr))
+            return
+        assert len(args) == 2, "Specify a key and a value"
+        key, value = args
+        self.config[key] = parse_config_value(key, value)
+        self.apply_config()
+        if self.verbose:
+            print('    {k} => {v}'.format(k=key, v=self.config[key]))
 
     def do_exit(self, args):
         """
         Exit the application.
         """
         print("See you soon!")
+        self.cache.close()
         sys.exit(0)
 
+    def do_stats(self, args):
+        """
+        Show timing statistics of the session.
+        Wall time per command (seconds), database calls per collection and
+        a histogram of command wall times. Commands slower than config
+        `slow_threshold` are appended to the slow query log.
+        """
+        writers.print_table(self.monitor.command_stats(), "Commands")
+        writers.print_table(self.monitor.coll_stats(), "Collections")
+        writers.print_histogram(self.monitor.histogram(), "Wall time")
+        if self.monitor.slow_log:
+            print("Slow commands are logged to {f}".format(
+                f=self.monitor.slow_log))
+
     def do_help(self, args):
         """
         Show help. Takes a command and display corresponding info.
@@ -276,7 +663,7 @@ class Finder(object):
             self._print_suggestions(cmd)
 
     def get_coll_names(self):
-        for coll_name in self.conn.collection_names():
+        for coll_name in self.conn.list_collection_names():
             if coll_name.startswith('_') and coll_name != "_vcs":
                 yield coll_name
 
@@ -288,12 +675,54 @@ class Finder(object):
             yield self.get_project_name(coll_name)
 
     def get_project(self, project):
-        return self.conn['_' + project]
+        if self.config['read_preference'] is None:
+            return self.conn['_' + project]
+        return self.conn.get_collection(
+            '_' + project, read_preference=connection.read_preference(
+                self.config['read_preference']))
 
     def get_projects(self):
         for project_name in self.get_project_names():
             yield self.get_project(project_name)
 
+    def field_values(self, field, limit):
+        """
+        Distinct values of a field over all projects, at most `limit`.
+        Projects with an index starting with the field are read through the
+        index alone. The others are scanned once per UNINDEXED_VALUES_TTL
+        (see `scanned_field_values`); index the field (`indexes ... create`)
+        to complete its latest values.
+        """
+        values = set()
+        for project in self.get_projects():
+            info = project.index_information()
+            if explain.has_index(info, [(field, 1)]) or \
+               explain.has_index(info, [(field, -1)]):
+                values.update(project.distinct(field, **self.query_options()))
+            else:
+                values.update(self.scanned_field_values(project, field))
+            if len(values) >= limit:
+                break
+        return list(values)[:limit]
+
+    def scanned_field_values(self, project, field):
+        """
+        Distinct values of an unindexed field of a project, read by a
+        collection scan at most every UNINDEXED_VALUES_TTL seconds. Scans
+        taking longer than UNINDEXED_VALUES_TIMEOUT give no values.
+        """
+        key = (project.name, field)
+        loaded_at, values = self.scanned_values.get(key, (None, []))
+        if loaded_at is None or time.time() - loaded_at > UNINDEXED_VALUES_TTL:
+            options = dict(self.query_options(),
+                           maxTimeMS=UNINDEXED_VALUES_TIMEOUT * 1000)
+            try:
+                values = project.distinct(field, **options)
+            except pymongo.errors.ExecutionTimeout:
+                values = []
+            self.scanned_values[key] = (time.time(), values)
+        return values
+
     def do_projects(self, args):
         """
         Show information about projects
@@ -303,76 +732,1034 @@ class Finder(object):
             for project_name in self.get_project_names():
                 print(project_name)
 
-    def groupcounts(self, project, groupkeys):
+    def map_projects(self, fn, project_names):
+        """
+        Apply `fn` to the collection of each project, running up to
+        `workers` projects concurrently over the shared connection pool.
+        Returns a dict from project name to result, in input order, and a
+        dict from project name to exception for the projects that failed.
+        """
+        project_names = list(project_names)
+        results, failed = {}, {}
+        lock = threading.Lock()
+        self.progress.update(done=0, total=len(project_names), rows=0)
+
+        def run(project):
+            if self.cancelled.is_set():
+                raise QueryCancelled()
+            result = self.retrying(lambda: fn(project))
+            with lock:
+                self.progress['done'] += 1
+                self.progress['rows'] += \
+                    len(result) if isinstance(result, list) else 1
+            return result
+
+        if self.config['workers'] <= 1:
+            for project_name in project_names:
+                try:
+                    results[project_name] = run(self.get_project(project_name))
+                except pymongo.errors.PyMongoError as e:
+                    failed[project_name] = e
+        else:
+            with ThreadPoolExecutor(self.config['workers']) as pool:
+                futures = [(project_name,
+                            pool.submit(self.monitor.bind(run),
+                                        self.get_project(project_name)))
+                           for project_name in project_names]
+                for project_name, future in futures:
+                    try:
+                        results[project_name] = future.result()
+                    except pymongo.errors.PyMongoError as e:
+                        failed[project_name] = e
+        if self.cancelled.is_set():  # killed operations fail as well
+            raise QueryCancelled()
+        return results, failed
+
+    def group_row(self, row_id, count):
+        """Transform a $group output row into a dict of groupby keys"""
+        row_dict = {}
+        row_dict['count'] = count
+        for key, value in row_id.items():
+            assert key != "count", "Found count field in groupby keys"
+            row_dict[key] = value
+        return row_dict
+
+    def groupcounts(self, project, groupkeys, match=None):
         result = []
+        if match is None:
+            match = self.query_filters()
         cursor = project.aggregate(
-            [{"$match": self.query_filters()},
+            [{"$match": match},
              {"$group": {"_id": {k: "$" + k for k in groupkeys},
-                         "count": {"$sum": 1}}}])
+                         "count": {"$sum": 1}}}],
+            **self.query_options())
         for row in cursor:      # transform mongodb cursor output
-            row_dict = {}
-            row_dict['count'] = row['count']
-            for key, value in row["_id"].items():
-                assert key != "count", "Found count field in groupby keys"
-                row_dict[key] = value
-            result.append(row_dict)
+            result.append(self.group_row(row["_id"], row["count"]))
+        return result
+
+    def partition_ranges(self, project, n):
+        """
+        Split a project into about `n` _id ranges of similar size, using
+        quantiles of a random sample of _id's as boundaries. Returns a list
+        of range conditions on _id (a single empty one if it can't split).
+        """
+        size = min(n * PARTITION_SAMPLES,
+                   project.estimated_document_count(**self.query_options()))
+        cursor = project.aggregate(
+            [{"$sample": {"size": size}}, {"$project": {"_id": 1}}],
+            **self.query_options())
+        try:
+            ids = sorted(doc['_id'] for doc in cursor)
+        except TypeError:       # _id's of mixed types
+            return [{}]
+        if len(ids) < n:        # (nearly) empty project
+            return [{}]
+        bounds = sorted(set(ids[len(ids) * i // n] for i in range(1, n)))
+        ranges, lower = [], None
+        for upper in bounds + [None]:
+            condition = {}
+            if lower is not None:
+                condition["$gte"] = lower
+            if upper is not None:
+                condition["$lt"] = upper
+            ranges.append(condition)
+            lower = upper
+        return ranges
+
+    def partitioned_groupcounts(self, project, groupkeys):
+        """
+        Like `groupcounts`, but running a partial $group per _id range of
+        the project concurrently (see config `partitions`) and merging the
+        partial counts. With config `check_partitions` on, the merged
+        counts are compared with those of a single pipeline.
+        """
+        filters = self.query_filters()
+        ranges = self.partition_ranges(project, self.config['partitions'])
+
+        def partial(condition):
+            if self.cancelled.is_set():
+                raise QueryCancelled()
+            match = filters
+            if condition:
+                match = {"$and": [filters, {"_id": condition}]}
+            return self.groupcounts(project, groupkeys, match)
+
+        with ThreadPoolExecutor(len(ranges)) as pool:
+            result = merge_group_rows(
+                pool.map(self.monitor.bind(partial), ranges))
+        if self.config['check_partitions']:
+            single = self.groupcounts(project, groupkeys, filters)
+            project_name = self.get_project_name(project.name)
+            if {group_key(row): row['count'] for row in single} == \
+               {group_key(row): row['count'] for row in result}:
+                print("Merged counts of [{n}] partitions of [{p}] match "
+                      "the single pipeline".format(n=len(ranges),
+                                                   p=project_name))
+            else:
+                print("Merged counts of [{p}] differ from the single "
+                      "pipeline, using the latter".format(p=project_name))
+                result = single
+        return result
+
+    def facetcounts(self, project, groupkey_sets):
+        """
+        Compute grouped counts for several sets of groupby keys reading the
+        project only once, through a $facet stage with a $group per set.
+        Returns a list of counts, one per set of groupby keys.
+        """
+        facets = {str(i): [{"$group": {"_id": {k: "$" + k for k in keys},
+                                       "count": {"$sum": 1}}}]
+                  for i, keys in enumerate(groupkey_sets)}
+        cursor = project.aggregate(
+            [{"$match": self.query_filters()}, {"$facet": facets}],
+            **self.query_options())
+        result = next(cursor)
+        return [[self.group_row(row["_id"], row["count"])
+                 for row in result[str(i)]]
+                for i in range(len(groupkey_sets))]
+
+    def approxcounts(self, project, groupkeys, sample_size):
+        """
+        Estimate grouped counts from a random sample of `sample_size`
+        documents of the project, scaled to its (metadata) document count.
+        Rows carry the bounds of a 95% confidence interval as `ci_low` and
+        `ci_high`. Without groupkeys a single row is returned.
+        """
+        total = project.estimated_document_count(**self.query_options())
+        sample_size = min(sample_size, total)
+        if sample_size > SAMPLE_SCAN_FRACTION * total:
+            print("Sample covers over {pct:.0%} of project [{p}], "
+                  "this reads the whole collection".format(
+                      pct=SAMPLE_SCAN_FRACTION,
+                      p=self.get_project_name(project.name)))
+        result = []
+        if sample_size > 0:
+            cursor = project.aggregate(
+                [{"$sample": {"size": sample_size}},
+                 {"$match": self.query_filters()},
+                 {"$group": {"_id": {k: "$" + k for k in groupkeys},
+                             "count": {"$sum": 1}}}],
+                **self.query_options())
+            for row in cursor:
+                estimate, low, high = sketches.sample_estimate(
+                    row["count"], sample_size, total)
+                row_dict = self.group_row(row["_id"] or {}, estimate)
+                row_dict.update(ci_low=low, ci_high=high)
+                result.append(row_dict)
+        if not groupkeys and not result:
+            estimate, low, high = sketches.sample_estimate(
+                0, sample_size, total)
+            result.append({'count': estimate, 'ci_low': low, 'ci_high': high})
         return result
 
+    def timelinecounts(self, project, unit, groupkeys):
+        """
+        Count annotations per `timestamp` bucket of the given unit (and
+        groupby keys), truncating timestamps on the server so that only the
+        histogram is transferred. Rows are sorted by bucket.
+        """
+        group_id = {k: "$" + k for k in groupkeys}
+        group_id['bucket'] = timeline.bucket_expr(unit, self.server_version())
+        cursor = project.aggregate(
+            [{"$match": self.query_filters()},
+             {"$group": {"_id": group_id, "count": {"$sum": 1}}},
+             {"$sort": {"_id.bucket": 1}}],
+            **self.query_options())
+        return [self.group_row(row["_id"], row["count"]) for row in cursor]
+
+    def distinct_sketch(self, project, field):
+        """
+        Stream the values of `field` in the matching documents of a project
+        into a HyperLogLog sketch of its distinct values.
+        """
+        sketch = sketches.HyperLogLog(DISTINCT_PRECISION)
+        cursor = project.aggregate(
+            [{"$match": self.query_filters()},
+             {"$project": {"_id": 0, "value": "$" + field}}],
+            batchSize=EXPORT_BATCH_SIZE, **self.query_options())
+        for doc in cursor:
+            if doc.get('value') is not None:
+                sketch.add(doc['value'])
+        return sketch
+
+    def unioncounts(self, project_names, groupkeys):
+        """
+        Compute grouped counts for several projects in a single aggregation
+        that $unionWith's all project collections, tagging each document with
+        its project. Returns a dict from project name to counts.
+        """
+        def tagged(project_name):
+            fields = {k: 1 for k in groupkeys}
+            fields[PROJECT_TAG] = {"$literal": project_name}
+            return [{"$match": self.query_filters()}, {"$project": fields}]
+
+        first, *rest = project_names
+        pipeline = tagged(first)
+        for project_name in rest:
+            pipeline.append(
+                {"$unionWith": {"coll": self.get_project(project_name).name,
+                                "pipeline": tagged(project_name)}})
+        pipeline.append(
+            {"$group": {"_id": {"project": "$" + PROJECT_TAG,
+                                "keys": {k: "$" + k for k in groupkeys}},
+                        "count": {"$sum": 1}}})
+        by_project = {project_name: [] for project_name in project_names}
+        options = {k: v for (k, v) in self.query_options().items()
+                   if k != 'maxTimeMS'}  # timeouts are per project
+        for row in self.get_project(first).aggregate(pipeline, **options):
+            by_project[row["_id"]["project"]].append(
+                self.group_row(row["_id"]["keys"], row["count"]))
+        return by_project
+
+    def count_strategy(self, project, filters):
+        """
+        Pick the cheapest way of counting the documents matching `filters`:
+          metadata: no filters, read the count from collection metadata
+          index: the filter keys prefix an index, count over that index only
+          filter: count the documents matching the filters
+        Returns the strategy name and the index to hint (or None).
+        """
+        if not filters:
+            return 'metadata', None
+        for index_name, info in project.index_information().items():
+            if info.get('sparse') or 'partialFilterExpression' in info:
+                continue        # partial indexes don't see all documents
+            index_keys = [key for key, _ in info['key']][:len(filters)]
+            if set(index_keys) == set(filters):
+                return 'index', index_name
+        return 'filter', None
+
+    def use_cache(self, groupkeys):
+        """
+        Whether to cache the current query: not for unfiltered counts, read
+        from collection metadata for less than the collection signal costs.
+        """
+        return self.config['cache'] and \
+            bool(groupkeys or any(self.filters.values()))
+
+    def cache_scope(self):
+        """Database of the session, to tell its entries in a shared cache"""
+        return [connection.uri_hosts(self.uri), self.db]
+
+    def cache_get(self, project, groupkeys):
+        """
+        Look up the current query on a project in the result cache.
+        Returns the collection signal to store the result with and the
+        cached result (None on a miss or without caching).
+        """
+        if not self.use_cache(groupkeys):
+            return None, None
+        signal = cache.collection_signal(project)
+        key = cache.query_key(project.name, self.query_filters(), groupkeys,
+                              scope=self.cache_scope())
+        return signal, self.cache.get(key, signal)
+
+    def cache_put(self, project, groupkeys, signal, result):
+        if self.use_cache(groupkeys):
+            key = cache.query_key(
+                project.name, self.query_filters(), groupkeys,
+                scope=self.cache_scope())
+            self.cache.put(key, signal, result)
+
+    def cached_unioncounts(self, project_names, groupkeys):
+        """Run `unioncounts` only over projects without a cached result"""
+        by_project, signals = {}, {}
+        for project_name in project_names:
+            signal, cached = self.cache_get(
+                self.get_project(project_name), groupkeys)
+            if cached is None:
+                signals[project_name] = signal
+            else:
+                by_project[project_name] = cached
+        if signals:
+            counts = self.unioncounts(list(signals), groupkeys)
+            for project_name, signal in signals.items():
+                self.cache_put(self.get_project(project_name), groupkeys,
+                               signal, counts[project_name])
+            by_project.update(counts)
+        return {p: by_project[p] for p in project_names}
+
     def simplecounts(self, project):
-        return project.find(self.query_filters()).count()
+        """Count matching documents returning the count and strategy used"""
+        filters = self.query_filters()
+        strategy, index_name = self.count_strategy(project, filters)
+        if strategy == 'metadata':
+            count = project.estimated_document_count(**self.query_options())
+        elif strategy == 'index':
+            count = project.count_documents(
+                filters, hint=index_name, **self.query_options())
+        else:
+            count = project.count_documents(filters, **self.query_options())
+        return count, strategy
 
-    def do_count(self, args):
+    def warn_unindexed_timestamp(self, project):
         """
-        Count annotations using the current filters.
-        Specify a project to get only counts for that project:
-          count myProject
-        Multiple projects can be specified with commas:
-          count myProject,projectTest,otherProject
+        Warn, once per project, if `timestamp` isn't indexed: incremental
+        scans by timestamp (rollup refreshes) then read the whole project.
+        """
+        if project.name in self.unindexed_warned:
+            return
+        self.unindexed_warned.add(project.name)
+        info = project.index_information()
+        if not (explain.has_index(info, [('timestamp', 1)]) or
+                explain.has_index(info, [('timestamp', -1)])):
+            print("No index on timestamp in project [{p}], rollup "
+                  "refreshes scan the whole collection".format(
+                      p=self.get_project_name(project.name)))
+
+    def count_projects(self, project_names, groupkeys=None, quiet=False):
+        """
+        Compute counts for each project, grouped by `groupkeys` if given.
+        Returns a dict from project name to counts and a dict from project
+        name to exception for the projects that failed. With `quiet`, empty
+        results and count strategies aren't reported.
+        """
+        def rollup_count(project):
+            project_name = self.get_project_name(project.name)
+            self.warn_unindexed_timestamp(project)
+            self.rollups.refresh(project, project_name,
+                                 max_age=self.config['rollup_refresh'])
+            counts = self.rollups.counts(project_name, groupkeys, self.filters)
+            return counts if groupkeys else (counts, 'rollup')
+
+        def count(project):
+            signal, cached = self.cache_get(project, groupkeys)
+            if cached is not None:
+                return cached if groupkeys else (cached[0], 'cache')
+            if groupkeys and self.config['partitions'] > 1:
+                result = self.partitioned_groupcounts(project, groupkeys)
+            elif groupkeys:
+                result = self.groupcounts(project, groupkeys)
+            else:
+                result = self.simplecounts(project)
+            self.cache_put(project, groupkeys, signal, result)
+            return result
+
+        project_names = list(project_names)
+        by_project = None
+        if self.config['rollups'] and \
+           self.rollups.supports(groupkeys, self.filters):
+            by_project, failed = self.map_projects(rollup_count, project_names)
+        elif groupkeys and self.config['union'] and len(project_names) > 1:
+            if self.server_version() < (4, 4):
+                print("$unionWith requires MongoDB 4.4, "
+                      "counting projects one by one")
+            else:
+                try:
+                    by_project = self.cached_unioncounts(
+                        project_names, groupkeys)
+                    failed = {}
+                except pymongo.errors.OperationFailure as e:
+                    if e.code != UNRECOGNIZED_STAGE:
+                        raise
+                    print("Server doesn't support $unionWith, "
+                          "counting projects one by one")
+        if by_project is None:
+            by_project, failed = self.map_projects(count, project_names)
+        if groupkeys:
+            for project_name, counts in list(by_project.items()):
+                if not counts:
+                    if not quiet:
+                        print("Empty results for project [%s]" %
+                              project_name)
+                    del by_project[project_name]
+        else:
+            strategies = {p: s for p, (_, s) in by_project.items()}
+            by_project = {p: c for p, (c, _) in by_project.items()}
+            if not quiet:
+                writers.print_strategies(strategies)
+        return by_project, failed
+
+    def count_facets(self, project_names, groupkey_sets):
+        """
+        Like `count_projects` for several sets of groupby keys at once.
+        Returns a list of dicts from project name to counts, one per set
+        of groupby keys, and a dict of failed projects.
+        """
+        by_project, failed = self.map_projects(
+            lambda project: self.facetcounts(project, groupkey_sets),
+            project_names)
+        by_facet = []
+        for i, groupkeys in enumerate(groupkey_sets):
+            facet = {}
+            for project_name, facets in by_project.items():
+                if facets[i]:
+                    facet[project_name] = facets[i]
+                else:
+                    print("Empty results for project [{p}] by [{keys}]".format(
+                        p=project_name, keys=",".join(groupkeys)))
+            by_facet.append(facet)
+        return by_facet, failed
+
+    def write_counts(self, by_project, groupkeys=None, outfile=None):
+        if outfile:
+            ext, compress = get_extension(outfile), is_compressed(outfile)
+            if groupkeys:
+                writers.write_count_group(
+                    by_project, groupkeys, outfile, ext, compress=compress)
+            else:
+                writers.write_count(
+                    by_project, outfile, ext, compress=compress)
+        else:
+            if groupkeys:
+                writers.print_count_group(by_project)
+            else:
+                writers.print_count(by_project)
+
+    def write_facets(self, by_facet, groupkey_sets, outfile=None):
+        """
+        Write the counts of each set of groupby keys as a separate table or,
+        if there are several sets, to a separate file named after the keys.
+        """
+        if len(groupkey_sets) == 1:
+            self.write_counts(by_facet[0], groupkey_sets[0], outfile)
+            return
+        for by_project, groupkeys in zip(by_facet, groupkey_sets):
+            if outfile:
+                self.write_counts(
+                    by_project, groupkeys, facet_filename(outfile, groupkeys))
+            else:
+                print("=== by {keys} ===".format(keys=",".join(groupkeys)))
+                self.write_counts(by_project, groupkeys)
+
+    def query_pipeline(self, groupkeys=None):
+        """Aggregation pipeline for the current filters, sort and groupby"""
+        pipeline = [{"$match": self.query_filters()}]
+        if self.sort_props:
+            pipeline.append({"$sort": dict(self.sort_spec())})
+        if groupkeys:
+            pipeline.append(
+                {"$group": {"_id": {k: "$" + k for k in groupkeys},
+                            "count": {"$sum": 1}}})
+        return pipeline
+
+    def explain_pipeline(self, project, pipeline):
+        return self.conn.command(
+            'explain',
+            {'aggregate': project.name, 'pipeline': pipeline, 'cursor': {}},
+            verbosity='executionStats')
+
+    def create_indexes(self, project_names, keys):
+        for project_name in project_names:
+            project = self.get_project(project_name)
+            name = project.create_index(keys)
+            print("Created index [{name}] in project [{project}]".format(
+                name=name, project=project_name))
+
+    def do_indexes(self, args):
+        """
+        Explain the current query and suggest indexes for it.
+        Shows the access plan (COLLSCAN, IXSCAN) and examined documents:
+          indexes myProject
+          indexes all groupby username,corpus
+        Create the suggested index where it is missing (asks confirmation):
+          indexes all groupby username,corpus create
         """
         assert args, "Specify a project (e.g. GET) or 'all' for all projects"
+        project, *rest = args
+        parsed_args = parse_rest(rest, {'groupby': ['key1,key2,etc'],
+                                        'create': []})
+        if project == 'all':
+            projects = list(self.get_project_names())
+        else:
+            projects = project.split(',')
+        groupkeys = []
+        if 'groupby' in parsed_args:
+            groupkeys = parsed_args['groupby']['key1,key2,etc'].split(',')
 
+        pipeline = self.query_pipeline(groupkeys)
         if self.verbose:
-            pprint(self.query_filters())
+            pprint(pipeline)
+        plans, failed = self.map_projects(
+            lambda p: explain.plan_summary(self.explain_pipeline(p, pipeline)),
+            projects)
+        writers.print_failed(failed)
+        writers.print_table(
+            [dict(project=project_name, **plan)
+             for project_name, plan in plans.items()], "Query plans")
+
+        keys = explain.suggest_index(
+            self.query_filters(), self.sort_spec(), groupkeys)
+        if not keys:
+            print("No filters, sort or groupby keys to index")
+            return
+        missing = [project_name for project_name in projects
+                   if not explain.has_index(
+                           self.get_project(project_name).index_information(),
+                           keys)]
+        print("Suggested index: {keys}".format(keys=keys))
+        print("Missing in [{n}] project(s): {projects}".format(
+            n=len(missing), projects=", ".join(missing)))
 
-        # parse arguments
+        def callback(res):
+            if res == 'y':
+                self.create_indexes(missing, keys)
+            elif res != 'n':
+                yield "Please answer (y,n)", callback
+
+        def confirm():
+            yield "Create index in [%d] project(s)? (y,n)" % len(missing), \
+                callback
+
+        # only the confirmation is deferred to the caller
+        if missing and 'create' in parsed_args:
+            return confirm()
+
+    def open_browser(self, project_name, fields):
+        """
+        Open a server-side cursor over the annotations of a project matching
+        the current filters, sorted by the current sort criteria (with _id
+        as tie-breaker) and projected onto the displayed fields.
+        """
+        sort = self.sort_spec()
+        if '_id' not in self.sort_props:
+            sort.append(('_id', pymongo.ASCENDING))
+        projection = {f: 1 for f in fields}
+        projection.update({k: 1 for (k, _) in sort})
+        self.browser = {'project': project_name, 'fields': fields,
+                        'sort': sort, 'projection': projection,
+                        'filters': self.query_filters(),
+                        'last': None, 'seen': 0}
+        self.browser['cursor'] = self.browser_cursor()
+
+    def browser_cursor(self):
+        """Cursor starting after the last seen annotation of the browser"""
+        browser = self.browser
+        filters = browser['filters']
+        if browser['last'] is not None:
+            after_last = keyset_filter(browser['sort'], browser['last'])
+            filters = {"$and": [filters, after_last]}
+        return self.get_project(browser['project']).find(
+            filters, projection=browser['projection'], sort=browser['sort'],
+            batch_size=self.config['page_size'])
+
+    def next_page(self):
+        """Fetch the next page of annotations from the browser cursor"""
+        browser = self.browser
+        rows = []
+        while len(rows) < self.config['page_size']:
+            try:
+                doc = next(browser['cursor'])
+            except StopIteration:
+                break
+            except (pymongo.errors.CursorNotFound,
+                    pymongo.errors.InvalidOperation):
+                # cursor timed out on the server, resume after last row
+                browser['cursor'] = self.browser_cursor()
+                continue
+            browser['last'] = {k: writers.get_in(doc, k)
+                               for (k, _) in browser['sort']}
+            rows.append(doc)
+        browser['seen'] += len(rows)
+        return rows
+
+    def show_page(self):
+        first = self.browser['seen'] + 1
+        rows = self.next_page()
+        if not rows:
+            print("No more results")
+            return
+        writers.print_annotations(
+            rows, self.browser['fields'],
+            "{project} [{first}-{last}]".format(
+                project=self.browser['project'], first=first,
+                last=self.browser['seen']))
+
+    def annotation_tuples(self, project_name, fields, limit=None):
+        """
+        Matching annotations of a project as tuples of `fields` values, in
+        the current sort order. The server flattens the requested fields
+        and sends raw BSON batches that are decoded a batch at a time,
+        without building nested dicts per annotation (see `rawbson`).
+        """
+        pipeline = rawbson.raw_pipeline(
+            self.query_filters(), self.sort_spec(), fields)
+        if limit is not None:
+            pipeline.append({"$limit": limit})
+        project = self.get_project(project_name)
+        options = dict(batchSize=EXPORT_BATCH_SIZE, allowDiskUse=True,
+                       **self.query_options())
+        try:
+            batches = project.aggregate_raw_batches(pipeline, **options)
+        except NotImplementedError:
+            # clients without raw batches (e.g. mongomock)
+            return rawbson.doc_tuples(
+                project.aggregate(pipeline, **options), fields)
+        return rawbson.raw_tuples(batches, fields)
+
+    def export_annotations(self, project_name, fields, outfile):
+        """Stream all matching annotations of a project into a file"""
+        writers.write_tuples(self.annotation_tuples(project_name, fields),
+                             fields, outfile, get_extension(outfile),
+                             compress=is_compressed(outfile))
+
+    def do_find(self, args):
+        """
+        Browse annotations matching the current filters and sort criteria.
+        Shows the first page (see config `page_size`), use `next` for more:
+          find myProject
+        Choose the fields to display with commas:
+          find myProject fields username,ann.key,ann.value,query
+        Export all matching annotations (csv, jsonl, parquet, with .gz):
+          find myProject output annotations.jsonl.gz
+        """
+        assert args, "Specify a project (e.g. GET)"
         project, *rest = args
-        parsed_args = parse_rest(rest, {'groupby': ['key1,key2,etc'],
-                                        'output':  ['filename']})
+        assert ',' not in project and project != 'all', \
+            "Specify a single project"
+        parsed_args = parse_rest(rest, {'fields': ['field1,field2,etc'],
+                                        'output': ['filename']})
+        fields = DISPLAY_FIELDS
+        if 'fields' in parsed_args:
+            fields = parsed_args['fields']['field1,field2,etc'].split(',')
+        if 'output' in parsed_args:
+            # the export rewrites the file from scratch, so it can be retried
+            self.retrying(lambda: self.export_annotations(
+                project, list(fields), parsed_args['output']['filename']))
+            return
+        if self.browser is not None:
+            self.browser['cursor'].close()
+        self.open_browser(project, list(fields))
+        self.show_page()
 
-        # gather projects
-        if project == 'all':
+    def do_next(self, args):
+        """
+        Show the next page of results of the last `find`.
+        """
+        assert self.browser is not None, "Run `find` first"
+        self.show_page()
+
+    def do_rollup(self, args):
+        """
+        Maintain pre-aggregated counts per username, corpus, ann.key and day.
+        With config `rollups` on, `count` answers from them when possible,
+        refreshing them at most every `rollup_refresh` seconds.
+          rollup update all: bring rollups up to date (first time: build)
+          rollup update myProject,otherProject
+          rollup drop myProject
+          rollup status
+        """
+        actions = ('update', 'drop', 'status')
+        assert args and args[0] in actions, \
+            "Specify one of {actions}".format(actions=actions)
+        action, *rest = args
+        if action == 'status':
+            writers.print_table(self.rollups.status(), "Rollups")
+            return
+        assert rest, "Specify a project (e.g. GET) or 'all' for all projects"
+        if rest[0] == 'all':
             projects = self.get_project_names()
+        else:
+            projects = rest[0].split(',')
+        for project_name in projects:
+            if action == 'drop':
+                self.rollups.drop(project_name)
+                continue
+            changed = self.rollups.refresh(
+                self.get_project(project_name), project_name)
+            print("Updated [{n}] annotations in project [{p}]".format(
+                n=changed, p=project_name))
+
+    def do_distinct(self, args):
+        """
+        Estimate the number of distinct values of a field using the current
+        filters, streaming values into mergeable HyperLogLog sketches
+        (constant memory, ~0.8% error):
+          distinct myProject username
+          distinct all ann.value
+        With several projects, their sketches are merged into a total.
+        """
+        assert len(args) == 2, "Specify a project (or 'all') and a field"
+        project, field = args
+        if project == 'all':
+            projects = list(self.get_project_names())
         else:
             projects = project.split(',')
+        by_project, failed = self.map_projects(
+            lambda p: self.distinct_sketch(p, field), projects)
+        writers.print_failed(failed)
+        rows = [{'project': project_name, 'distinct': sketch.count()}
+                for project_name, sketch in by_project.items()]
+        if len(by_project) > 1:
+            total = sketches.HyperLogLog(DISTINCT_PRECISION)
+            for sketch in by_project.values():
+                total.merge(sketch)
+            rows.append({'project': 'all', 'distinct': total.count()})
+        writers.print_table(rows, "Distinct [{field}] (error ~{e:.1%})".format(
+            field=field, e=sketches.HyperLogLog(DISTINCT_PRECISION).error()))
 
-        by_project = {}
+    def do_timeline(self, args):
+        """
+        Show annotation activity over time using the current filters.
+        Counts per day (or hour, week, month, year) are shown as sparklines:
+          timeline myProject
+          timeline all by week
+        A sparkline per combination of groupby keys:
+          timeline all by month groupby username
+        Write the buckets to csv, jsonl or parquet files (optionally .gz):
+          timeline all by week groupby username output activity.csv
+        """
+        assert args, "Specify a project (e.g. GET) or 'all' for all projects"
+        project, *rest = args
+        parsed_args = parse_rest(rest, {'by': ['unit'],
+                                        'groupby': ['key1,key2,etc'],
+                                        'output': ['filename']})
+        if project == 'all':
+            projects = list(self.get_project_names())
+        else:
+            projects = project.split(',')
+        unit = parsed_args.get('by', {}).get('unit', 'day')
+        assert unit in timeline.UNITS, \
+            "Specify one of {units}".format(units=tuple(timeline.UNITS))
+        groupkeys = []
+        if 'groupby' in parsed_args:
+            groupkeys = parsed_args['groupby']['key1,key2,etc'].split(',')
+
+        by_project, failed = self.map_projects(
+            lambda p: self.timelinecounts(p, unit, groupkeys), projects)
+        writers.print_failed(failed)
+        outfile = parsed_args.get('output', {}).get('filename')
+        if outfile:
+            for rows in by_project.values():
+                for row in rows:
+                    if row['bucket'] is not None:
+                        row['bucket'] = timeline.format_bucket(
+                            row['bucket'], unit)
+            self.write_counts(by_project, ['bucket'] + groupkeys, outfile)
+            return
+        lines = {}
+        for project_name, rows in by_project.items():
+            lines[project_name] = []
+            for keys, (first, last, counts) in timeline.series(
+                    rows, unit, groupkeys).items():
+                lines[project_name].append(
+                    (",".join(str(k) for k in keys) or 'all',
+                     timeline.format_bucket(first, unit),
+                     timeline.format_bucket(last, unit), counts))
+        writers.print_timeline(lines, "Annotations per {unit}".format(
+            unit=unit))
+
+    def do_textindex(self, args):
+        """
+        Maintain the local trigram index of text fields (query, ann.value).
+        With config `text_index` on, unanchored regex filters on indexed
+        fields first narrow the candidates through it (annotations written
+        since the build are still regex-matched, an index on `timestamp`
+        keeps that cheap):
+          textindex build all: index query and ann.value of all projects
+          textindex build myProject fields query
+          textindex drop myProject
+          textindex status
+        """
+        actions = ('build', 'drop', 'status')
+        assert args and args[0] in actions, \
+            "Specify one of {actions}".format(actions=actions)
+        action, *rest = args
+        if action == 'status':
+            writers.print_table(self.textindex.status(), "Text index")
+            return
+        assert rest, "Specify a project (e.g. GET) or 'all' for all projects"
+        project, *rest = rest
+        parsed_args = parse_rest(rest, {'fields': ['field1,field2,etc']})
+        if project == 'all':
+            projects = list(self.get_project_names())
+        else:
+            projects = project.split(',')
+        fields = textindex.TEXT_FIELDS
+        if 'fields' in parsed_args:
+            fields = parsed_args['fields']['field1,field2,etc'].split(',')
         for project_name in projects:
-            project = self.get_project(project_name)
+            if action == 'drop':
+                self.textindex.drop(project_name)
+                continue
+            for field in fields:
+                n = self.textindex.build(
+                    self.get_project(project_name), project_name, field)
+                print("Indexed [{n}] values of [{field}] in project "
+                      "[{p}]".format(n=n, field=field, p=project_name))
 
-            # compute counts
-            if 'groupby' in parsed_args:
-                groupkeys = parsed_args['groupby']['key1,key2,etc'].split(',')
-                counts = self.groupcounts(project, groupkeys)
-                if counts:
-                    by_project[project_name] = counts
-                else:
-                    print("Empty results for project [%s]" % project_name)
-            else:
-                by_project[project_name] = self.simplecounts(project)
+    def do_snapshot(self, args):
+        """
+        Copy projects into a local columnar (parquet) snapshot for offline
+        analysis (start the CLI with --offline to query it). Later updates
+        only copy annotations written since the last one:
+          snapshot update all: copy the annotations matching current filters
+          snapshot update myProject,otherProject
+          snapshot drop myProject
+          snapshot status
+        """
+        actions = ('update', 'drop', 'status')
+        assert args and args[0] in actions, \
+            "Specify one of {actions}".format(actions=actions)
+        assert self.snapshot_dir, "Start the CLI with a snapshot directory"
+        store = snapshot.Snapshot(self.snapshot_dir)
+        action, *rest = args
+        if action == 'status':
+            writers.print_table(store.status(), "Snapshot")
+            return
+        assert rest, "Specify a project (e.g. GET) or 'all' for all projects"
+        if rest[0] == 'all':
+            projects = list(self.get_project_names())
+        else:
+            projects = rest[0].split(',')
+        for project_name in projects:
+            if action == 'drop':
+                store.drop(project_name)
+                continue
+            copied = self.retrying(lambda: store.refresh(
+                self.get_project(project_name), project_name,
+                self.query_filters()))
+            print("Copied [{n}] annotations of project [{p}]".format(
+                n=copied, p=project_name))
 
-        # display output
-        if 'output' in parsed_args:
-            outfile = parsed_args['output']['filename']
-            ext = get_extension(outfile)
-            if ext == 'csv':
-                if 'groupby' in parsed_args:
-                    writers.csv_count_group(by_project, outfile)
-                else:
-                    writers.csv_count(by_project, outfile)
-            else:
-                raise ValueError("Unrecognized extension [%s]" % ext)
+    def do_agreement(self, args):
+        """
+        Compare the annotations of each pair of annotators for an ann.key.
+        Uses the current filters (e.g. corpus) and shows, per pair, the
+        overlapping and exactly matching spans, how many exact matches got
+        the same value and Cohen's kappa of the values:
+          agreement myProject pos
+        Write the table to csv, jsonl or parquet files (optionally .gz):
+          agreement myProject pos output agreement.csv
+        """
+        assert len(args) >= 2, "Specify a project (e.g. GET) and an ann.key"
+        project, key, *rest = args
+        assert ',' not in project and project != 'all', \
+            "Specify a single project"
+        parsed_args = parse_rest(rest, {'output': ['filename']})
+        filters = dict(self.query_filters(), **{'ann.key': key})
+        cursor = self.get_project(project).aggregate(
+            agreement.span_pipeline(filters), allowDiskUse=True,
+            batchSize=EXPORT_BATCH_SIZE, **self.query_options())
+        rows, skipped = agreement.agreement(cursor)
+        if skipped:
+            print("Skipped [{n}] annotations without span.doc or scope".format(
+                n=skipped))
+        outfile = parsed_args.get('output', {}).get('filename')
+        if outfile:
+            writers.write_rows(
+                rows, writers.header_from_results(rows), outfile,
+                get_extension(outfile), compress=is_compressed(outfile))
         else:
-            if 'groupby' in parsed_args:
-                writers.print_count_group(by_project)
-            else:
-                writers.print_count(by_project)
+            writers.print_table(rows, "Agreement on [{key}] in [{p}]".format(
+                key=key, p=project))
+
+    def do_watch(self, args):
+        """
+        Follow the annotation rate live, per username, corpus and ann.key,
+        over a sliding window (default 60 seconds), using the current
+        filters. Changes come from a change stream (replica sets) or from
+        polling the timestamps of the projects. Ctrl-C (or `cancel watch`
+        in async mode, where it runs alongside other commands) stops
+        watching:
+          watch all
+          watch myProject,otherProject window 300 refresh 5
+        Stop after a number of seconds (e.g. in batch scripts):
+          watch all for 600
+        """
+        assert args, "Specify a project (e.g. GET) or 'all' for all projects"
+        project, *rest = args
+        if project == 'all':
+            projects = list(self.get_project_names())
+        else:
+            projects = project.split(',')
+        parsed_args = parse_rest(rest, {'window': ['seconds'],
+                                        'refresh': ['seconds'],
+                                        'for': ['seconds']})
+        seconds = {'window': 60, 'refresh': 2, 'for': None}
+        for option, value in parsed_args.items():
+            value = value['seconds']
+            if not value.isdigit() or int(value) == 0:
+                raise ParseError(value, option + " <positive integer>")
+            seconds[option] = int(value)
+
+        counter = watch.WindowCounter(window=seconds['window'])
+        match = watch.matcher(self.filters)
+        colls = [self.get_project(project_name) for project_name in projects]
+        changes = watch.change_stream(
+            self.conn, [coll.name for coll in colls], seconds['refresh'])
+        title = "Annotations in [{p}] over the last {w}s".format(
+            p=project, w=seconds['window'])
+        # redraw in place unless running as a background job
+        redraw = threading.current_thread() is threading.main_thread()
+        self.progress.update(done=0, total=len(colls), rows=0)
+        started = last_shown = time.time()
+        try:
+            while seconds['for'] is None or \
+                  time.time() - started < seconds['for']:
+                if self.cancelled.is_set():
+                    raise QueryCancelled()
+                try:
+                    doc = next(changes)
+                except pymongo.errors.OperationFailure as e:
+                    if e.code != watch.NO_CHANGE_STREAMS:
+                        raise
+                    print("No change streams on this server, polling")
+                    changes = watch.poll_changes(colls, seconds['refresh'])
+                    continue
+                if doc is not None and match(doc):
+                    counter.add(doc)
+                    self.progress['rows'] += 1
+                if time.time() - last_shown >= seconds['refresh']:
+                    writers.print_watch(counter.rows(), title, redraw=redraw)
+                    last_shown = time.time()
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        finally:
+            changes.close()
+
+    def parse_count_args(self, args):
+        """
+        Parse `count` arguments into a list of project names, a list of sets
+        of groupby keys (or None), an output filename (or None) and a sample
+        size for approximate counts (or None).
+        """
+        assert args, "Specify a project (e.g. GET) or 'all' for all projects"
+        project, *rest = args
+        # allow spaces around the pipes separating groupby key sets
+        rest = re.sub(r"\s*\|\s*", "|", " ".join(rest)).split()
+        parsed_args = parse_rest(rest, {'groupby': ['key1,key2|key3,etc'],
+                                        'output':  ['filename'],
+                                        'approx': ['sample_size']})
+
+        # gather projects
+        if project == 'all':
+            projects = list(self.get_project_names())
+        else:
+            projects = project.split(',')
+
+        groupkey_sets = None
+        if 'groupby' in parsed_args:
+            groupkey_sets = [
+                keys.split(',') for keys in
+                parsed_args['groupby']['key1,key2|key3,etc'].split('|')]
+            assert all(all(keys) for keys in groupkey_sets), \
+                "Empty groupby key"
+        outfile = parsed_args.get('output', {}).get('filename')
+        sample_size = None
+        if 'approx' in parsed_args:
+            sample_size = parsed_args['approx']['sample_size']
+            if not sample_size.isdigit() or int(sample_size) == 0:
+                raise ParseError(sample_size, "approx <positive integer>")
+            sample_size = int(sample_size)
+            assert not groupkey_sets or len(groupkey_sets) == 1, \
+                "approx takes a single set of groupby keys"
+        return projects, groupkey_sets, outfile, sample_size
+
+    def run_count(self, projects, groupkey_sets=None, outfile=None,
+                  sample_size=None):
+        """
+        Count and write the output of a `count` command. Several sets of
+        groupby keys are computed in a single scan per project ($facet).
+        With a `sample_size` counts are estimated from a random sample.
+        Returns the projects that failed.
+        """
+        if sample_size:
+            groupkeys = groupkey_sets[0] if groupkey_sets else []
+            by_project, failed = self.map_projects(
+                lambda p: self.approxcounts(p, groupkeys, sample_size),
+                projects)
+            writers.print_failed(failed)
+            self.write_counts(
+                by_project, groupkeys + ['ci_low', 'ci_high'], outfile)
+            return failed
+        if groupkey_sets and len(groupkey_sets) > 1:
+            by_facet, failed = self.count_facets(projects, groupkey_sets)
+            writers.print_failed(failed)
+            self.write_facets(by_facet, groupkey_sets, outfile)
+            return failed
+        groupkeys = groupkey_sets[0] if groupkey_sets else None
+        by_project, failed = self.count_projects(projects, groupkeys)
+        writers.print_failed(failed)
+
+        # display output
+        self.write_counts(by_project, groupkeys, outfile)
+        return failed
+
+    def do_count(self, args):
+        """
+        Count annotations using the current filters.
+        Specify a project to get only counts for that project:
+          count myProject
+        Multiple projects can be specified with commas:
+          count myProject,projectTest,otherProject
+        Independent groupings separated by | are computed in a single scan,
+        writing a table (or file) per grouping:
+          count all groupby username | corpus | ann.key
+        Projects are queried concurrently if config `workers` is above 1,
+        and grouped counts of each project are split into concurrent _id
+        ranges if config `partitions` is above 1.
+        With config `union` on, grouped counts over several projects run as
+        a single server-side query.
+        With config `rollups` on, counts by username, corpus and ann.key
+        (without regex filters) are answered from the rollups (see `rollup`).
+        Write output to csv, jsonl or parquet files (optionally .gz):
+          count all groupby username,corpus output counts.csv.gz
+        Estimate counts from a random sample of documents per project, with
+        95% confidence intervals (ci_low, ci_high), for huge projects:
+          count all groupby username approx 10000
+        """
+        if self.verbose:
+            pprint(self.query_filters())
+
+        self.run_count(*self.parse_count_args(args))
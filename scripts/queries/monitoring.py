@@ -0,0 +1,254 @@
+import json
+import time
+import threading
+from collections import defaultdict, deque
+
+import bson
+from pymongo import monitoring
+
+__all__ = (
+    'QueryMonitor',
+    'percentile'
+)
+
+# Number of recent durations kept per command for the rolling histogram
+WINDOW = 1000
+
+# One decoded reply in BYTES_SAMPLE per collection is re-encoded to measure
+# its size, the size of the others is estimated from their document count
+BYTES_SAMPLE = 20
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def raw_batch(reply):
+    """
+    The raw BSON document stream of a reply to a raw batch cursor (e.g.
+    `aggregate_raw_batches`), or None for decoded replies
+    """
+    cursor = reply.get('cursor')
+    if cursor is None:
+        return None
+    batch = cursor.get('firstBatch', cursor.get('nextBatch', []))
+    if batch and isinstance(batch[0], (bytes, memoryview)):
+        return batch[0]
+    return None
+
+
+def stream_docs(data):
+    """Number of documents in a raw BSON document stream"""
+    n = i = 0
+    while i < len(data):
+        i += int.from_bytes(data[i:i + 4], 'little')
+        n += 1
+    return n
+
+
+def reply_docs(command_name, reply):
+    """Number of documents returned by a command reply"""
+    cursor = reply.get('cursor')
+    if cursor is not None:
+        data = raw_batch(reply)
+        if data is not None:
+            return stream_docs(data)
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if command_name == 'distinct':
+        return len(reply.get('values', []))
+    return 1 if reply.get('ok') else 0
+
+
+class QueryMonitor(monitoring.CommandListener):
+    """
+    Query instrumentation fed by pymongo's command monitoring events.
+
+    Keeps per-collection totals of database calls (round-trip time,
+    documents and bytes returned, see `reply_bytes`), a rolling window of
+    wall times per CLI command and a log of slow commands, written as JSON
+    lines together with the database commands they ran.
+
+    The running CLI command is tracked per thread, so that commands run
+    concurrently (background jobs, batch jobs) on forks sharing the
+    monitor keep their own timer and calls. Work handed to other threads
+    on behalf of a command must be wrapped with `bind`. Database calls
+    made outside any command only count in the totals.
+
+    :param slow_log: Optional, file to which slow commands are appended.
+    :param slow_threshold: seconds above which a command is logged as slow.
+    """
+    def __init__(self, slow_log=None, slow_threshold=1.0):
+        self.slow_log = slow_log
+        self.slow_threshold = slow_threshold
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.local = threading.local()  # CLI command running in a thread
+        self.by_coll = defaultdict(lambda: defaultdict(float))
+        # collection -> [replies, measured bytes, documents of those]
+        self.sizes = defaultdict(lambda: [0, 0, 0])
+        self.durations = defaultdict(lambda: deque(maxlen=WINDOW))
+
+    # pymongo.monitoring.CommandListener
+
+    def started(self, event):
+        command = event.command
+        coll = command.get(event.command_name)
+        if event.command_name == 'getMore':
+            coll = command.get('collection')
+        if not isinstance(coll, str):
+            return              # handshakes, auth, admin commands
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = {
+                'command': event.command_name, 'coll': coll,
+                'pipeline': command.get('pipeline'),
+                'filter': command.get('filter', command.get('query')),
+                'cli_command': getattr(self.local, 'command', None)}
+
+    def succeeded(self, event):
+        with self.lock:
+            call = self.pending.pop(
+                (event.connection_id, event.request_id), None)
+        if call is None:
+            return
+        call['ms'] = event.duration_micros / 1000
+        call['docs'] = reply_docs(event.command_name, event.reply)
+        call['bytes'] = self.reply_bytes(call['coll'], call['docs'],
+                                         event.reply)
+        self._record(call)
+
+    def failed(self, event):
+        with self.lock:
+            call = self.pending.pop(
+                (event.connection_id, event.request_id), None)
+        if call is None:
+            return
+        call.update(ms=event.duration_micros / 1000, docs=0, bytes=0,
+                    failure=str(event.failure))
+        self._record(call)
+
+    def reply_bytes(self, coll, docs, reply):
+        """
+        Size of a reply without re-encoding every one on the hot path:
+        exact for raw batches, measured for one decoded reply in
+        BYTES_SAMPLE per collection and estimated for the others from the
+        measured bytes per document.
+        """
+        data = raw_batch(reply)
+        if data is not None:
+            return len(data)
+        with self.lock:
+            sizes = self.sizes[coll]
+            measure = sizes[0] % BYTES_SAMPLE == 0
+            sizes[0] += 1
+            if not measure:
+                return int(sizes[1] / max(sizes[2], 1) * max(docs, 1))
+        size = len(bson.encode(reply))
+        with self.lock:
+            sizes[1] += size
+            sizes[2] += max(docs, 1)
+        return size
+
+    def _record(self, call):
+        with self.lock:
+            stats = self.by_coll[call['coll']]
+            stats['calls'] += 1
+            stats['ms'] += call['ms']
+            stats['docs'] += call['docs']
+            stats['bytes'] += call['bytes']
+            stats['failed'] += 'failure' in call
+            command = call.pop('cli_command')
+            if command is not None:
+                command['calls'].append(call)
+
+    # CLI command dispatch
+
+    def begin(self):
+        """Start timing a CLI command in the current thread"""
+        self.local.command = {'started_at': time.perf_counter(),
+                              'calls': [],
+                              'outer': getattr(self.local, 'command', None)}
+
+    def bind(self, fn):
+        """
+        Wrap `fn` so that the database calls it makes, from any thread,
+        are attributed to the CLI command running in the current thread.
+        """
+        command = getattr(self.local, 'command', None)
+
+        def bound(*args, **kwargs):
+            outer = getattr(self.local, 'command', None)
+            self.local.command = command
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.command = outer
+        return bound
+
+    def end(self, text):
+        """
+        Record the wall time of the CLI command of the current thread.
+        Returns a summary of the command including its database calls.
+        """
+        command = self.local.command
+        self.local.command = command['outer']
+        elapsed = time.perf_counter() - command['started_at']
+        cmd = text.split()[0]
+        with self.lock:
+            self.durations[cmd].append(elapsed)
+            calls = list(command['calls'])
+        return {'command': text, 'seconds': elapsed,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'db_ms': sum(call['ms'] for call in calls),
+                'docs': sum(call['docs'] for call in calls),
+                'bytes': sum(call['bytes'] for call in calls),
+                'calls': calls}
+
+    def is_slow(self, summary):
+        return self.slow_threshold is not None and \
+            summary['seconds'] >= self.slow_threshold
+
+    def log_slow(self, summary):
+        if self.slow_log is None:
+            return
+        with open(self.slow_log, 'a') as f:
+            f.write(json.dumps(summary, default=str))
+            f.write('\n')
+
+    # Summaries
+
+    def command_stats(self):
+        rows = []
+        with self.lock:
+            durations = {cmd: list(ds) for cmd, ds in self.durations.items()}
+        for cmd, ds in sorted(durations.items()):
+            rows.append({'command': cmd, 'calls': len(ds),
+                         'mean': '%.3f' % (sum(ds) / len(ds)),
+                         'p50': '%.3f' % percentile(ds, 50),
+                         'p90': '%.3f' % percentile(ds, 90),
+                         'p99': '%.3f' % percentile(ds, 99),
+                         'max': '%.3f' % max(ds)})
+        return rows
+
+    def coll_stats(self):
+        with self.lock:
+            return [{'collection': coll, 'calls': int(stats['calls']),
+                     'failed': int(stats['failed']),
+                     'db_ms': '%.1f' % stats['ms'],
+                     'docs': int(stats['docs']),
+                     'bytes': int(stats['bytes'])}
+                    for coll, stats in sorted(self.by_coll.items())]
+
+    def histogram(self, buckets=(0.01, 0.1, 0.5, 1, 5, 30, 60)):
+        """Counts of command wall times (all commands) per upper bound"""
+        with self.lock:
+            ds = [d for cmd_ds in self.durations.values() for d in cmd_ds]
+        counts, bounds = [], list(buckets) + [float('inf')]
+        lower = 0
+        for upper in bounds:
+            counts.append((upper, sum(1 for d in ds if lower <= d < upper)))
+            lower = upper
+        return counts
@@ -0,0 +1,110 @@
+from finder import Finder
+import snapshot
+
+__all__ = (
+    'OfflineFinder',
+)
+
+
+class SnapshotProject(object):
+    """Stand-in for a project collection, backed by its snapshot table"""
+    def __init__(self, name, table):
+        self.name = name
+        self.table = table
+
+
+class OfflineFinder(Finder):
+    """
+    Finder answering `count` (with groupby and the current filters) from a
+    local snapshot (see `snapshot`) with vectorized Arrow operations,
+    without any database connection. Commands that need the database are
+    refused, and the result cache, rollups, union counts and partitions
+    are disabled.
+
+    :param path: directory of the snapshot.
+    """
+    # Commands that only work against the database
+    ONLINE_COMMANDS = ('find', 'next', 'indexes', 'rollup', 'textindex',
+                       'timeline', 'distinct', 'reconnect', 'snapshot',
+                       'watch', 'agreement')
+
+    def __init__(self, path, verbose=True, config=None, **kwargs):
+        self.snapshot = snapshot.Snapshot(path)
+        super(OfflineFinder, self).__init__(
+            None, None, verbose=verbose, config=config, snapshot_dir=path,
+            **kwargs)
+
+    def connect(self, client=None):
+        self.conn = None
+        print("Offline, reading snapshot in {path}".format(
+            path=self.snapshot.path))
+
+    def apply_config(self):
+        super(OfflineFinder, self).apply_config()
+        for key in ('cache', 'rollups', 'union'):
+            self.config[key] = False
+        self.config['partitions'] = 1
+
+    def server_version(self):
+        return (0, 0)
+
+    def parse(self, text):
+        cmd = text.split()[0]
+        if cmd in self.ONLINE_COMMANDS:
+            print("[{cmd}] needs a database connection".format(cmd=cmd))
+            return
+        return super(OfflineFinder, self).parse(text)
+
+    def get_coll_names(self):
+        for project_name in self.snapshot.project_names():
+            yield '_' + project_name
+
+    def get_project(self, project):
+        return SnapshotProject('_' + project, self.snapshot.table(project))
+
+    def field_values(self, field, limit):
+        values = set()
+        for project_name in self.snapshot.project_names():
+            table = self.snapshot.table(project_name)
+            if field in table.column_names:
+                values.update(table[field].unique().to_pylist())
+        return list(values)[:limit]
+
+    def filtered(self, project):
+        expression = snapshot.filter_expression(self.filters)
+        if expression is None:
+            return project.table
+        return project.table.filter(expression)
+
+    def cache_get(self, project, groupkeys):
+        return None, None
+
+    def cache_put(self, project, groupkeys, signal, result):
+        pass
+
+    def simplecounts(self, project):
+        return self.filtered(project).num_rows, 'snapshot'
+
+    def groupcounts(self, project, groupkeys):
+        table = self.filtered(project)
+        for key in groupkeys:
+            assert key in table.column_names, \
+                "Field [%s] isn't in snapshots" % key
+        rows = table.group_by(groupkeys).aggregate([([], 'count_all')])
+        return [self.group_row({k: row[k] for k in groupkeys},
+                               row['count_all'])
+                for row in rows.to_pylist()]
+
+    def facetcounts(self, project, groupkey_sets):
+        return [self.groupcounts(project, groupkeys)
+                for groupkeys in groupkey_sets]
+
+    def approxcounts(self, project, groupkeys, sample_size):
+        """Snapshots are local, so approximate counts are exact"""
+        if groupkeys:
+            rows = self.groupcounts(project, groupkeys)
+        else:
+            rows = [{'count': self.filtered(project).num_rows}]
+        for row in rows:
+            row.update(ci_low=row['count'], ci_high=row['count'])
+        return rows
@@ -1,11 +1,19 @@
 
+import time
 import inspect
+import threading
+from bisect import bisect_left
 from prompt_toolkit.completion import Completer, Completion
 
 __all__ = (
-    'ClassCompleter'
+    'ClassCompleter',
+    'PrefixIndex',
+    'ValueCache'
 )
 
+# Completions shown at most for a value prefix
+MAX_COMPLETIONS = 50
+
 
 def get_methods(methods, prefix, ignore_private):
     for method_name, method in methods:
@@ -18,6 +26,89 @@ def get_methods(methods, prefix, ignore_private):
         yield method_name, method.__doc__
 
 
+class PrefixIndex(object):
+    """
+    Sorted word list answering prefix queries by binary search, in
+    O(log n + matches) time instead of scanning every word.
+
+    :param words: iterable of words.
+    :param ignore_case: If True, case-insensitive lookup.
+    """
+    def __init__(self, words=(), ignore_case=False):
+        self.ignore_case = ignore_case
+        self.keys = sorted((self.key(word), word) for word in set(words))
+
+    def key(self, word):
+        return word.lower() if self.ignore_case else word
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix, limit=None):
+        """Words starting with prefix, in order, at most `limit` of them"""
+        prefix = self.key(prefix)
+        i = bisect_left(self.keys, (prefix,))
+        found = 0
+        while i < len(self.keys) and self.keys[i][0].startswith(prefix):
+            if limit is not None and found >= limit:
+                return
+            yield self.keys[i][1]
+            i += 1
+            found += 1
+
+
+class ValueCache(object):
+    """
+    Prefix indexes of project names and of the distinct values of some
+    annotation fields, loaded in a background thread so that lookups never
+    wait for the database. Lookups return the indexes loaded so far and
+    start a refresh if they are older than `ttl` seconds.
+
+    :param load_projects: function returning the project names.
+    :param load_values: function from field and maximum number of values
+        to distinct values of the field over all projects.
+    :param fields: fields whose values are completed.
+    :param ttl: seconds before the indexes are refreshed.
+    :param max_values: maximum number of values loaded per field.
+    """
+    def __init__(self, load_projects, load_values,
+                 fields=('username', 'corpus', 'ann.key'), ttl=300,
+                 max_values=50000):
+        self.load_projects = load_projects
+        self.load_values = load_values
+        self.fields = fields
+        self.ttl = ttl
+        self.max_values = max_values
+        self.lock = threading.Lock()
+        self.indexes = {}       # 'projects' or field -> PrefixIndex
+        self.loaded_at = None
+        self.loading = False
+
+    def refresh(self):
+        try:
+            indexes = {'projects': PrefixIndex(self.load_projects())}
+            for field in self.fields:
+                values = self.load_values(field, self.max_values)
+                indexes[field] = PrefixIndex(
+                    str(value) for value in values if value is not None)
+            self.indexes = indexes
+        except Exception:
+            pass                # completion is best effort, retry later
+        finally:
+            with self.lock:
+                self.loaded_at, self.loading = time.time(), False
+
+    def get(self, name):
+        """Prefix index of `name` ('projects' or a field), maybe empty"""
+        with self.lock:
+            stale = self.loaded_at is None or \
+                time.time() - self.loaded_at > self.ttl
+            if stale and not self.loading:
+                self.loading = True
+                threading.Thread(target=self.refresh, daemon=True).start()
+        return self.indexes.get(name, PrefixIndex())
+
+
 class ClassCompleter(Completer):
     """
     Class-based autocompletion for prompt_toolkit
@@ -34,21 +125,62 @@ class ClassCompleter(Completer):
         metadata.
     :param match_middle: When True, match not only the start, but also in the
         middle of the word.
+    :param values: Optional, ValueCache completing project names and
+        `filter key:value` values.
+    :param project_args: Optional, dict from command to the position of its
+        project argument (e.g. {'count': 1}).
     """
     def __init__(self, cls, prefix=None, ignore_case=False, match_middle=False,
-                 trim_docstr=True, ignore_private=True, include_docstr=True):
+                 trim_docstr=True, ignore_private=True, include_docstr=True,
+                 values=None, project_args=None):
         self.prefix = prefix
         self.ignore_case = ignore_case
         self.match_middle = match_middle
         self.trim_docstr = trim_docstr
         self.ignore_private = ignore_private
         self.include_docstr = include_docstr
+        self.values = values
+        self.project_args = project_args or {}
         self.words = {method: docstr
                       for (method, docstr)
                       in get_methods(inspect.getmembers(cls),
                                      self.prefix, self.ignore_private)}
+        self.index = PrefixIndex(self.words, ignore_case=ignore_case)
 
     def get_completions(self, document, complete_event):
+        text = document.text_before_cursor
+        tokens = text.split()
+        position = len(tokens) if text[-1:].isspace() else len(tokens) - 1
+        if position > 0 and self.values is not None:
+            yield from self.value_completions(
+                tokens[0], position, '' if text[-1:].isspace() else tokens[-1])
+            return
+        if position > 0:
+            return
+        yield from self.command_completions(document)
+
+    def value_completions(self, cmd, position, word):
+        """Complete project names and the values of `filter key:value`"""
+        if cmd == 'filter' and ':' in word:
+            key, value = word.split(':', 1)
+            if key in self.values.fields:
+                for match in self.values.get(key).complete(
+                        value, limit=MAX_COMPLETIONS):
+                    yield Completion(match, -len(value))
+        elif cmd == 'filter':
+            for key in self.values.fields:
+                if key.startswith(word):
+                    yield Completion(key + ':', -len(word))
+        elif self.project_args.get(cmd) == position:
+            if 'all'.startswith(word):
+                yield Completion('all', -len(word))
+            # complete the last of comma-separated projects
+            _, _, last = word.rpartition(',')
+            for match in self.values.get('projects').complete(
+                    last, limit=MAX_COMPLETIONS):
+                yield Completion(match, -len(last))
+
+    def command_completions(self, document):
         word_before_cursor = document.get_word_before_cursor()
 
         if self.ignore_case:
@@ -64,17 +196,20 @@ class ClassCompleter(Completer):
             else:
                 return word.startswith(word_before_cursor)
 
-        for word in self.words.keys():
-            if word_matches(word):
-                if self.include_docstr:
-                    display_meta = self.words[word]
-                    if self.trim_docstr:
-                        display_meta = display_meta.strip().split("\n")
-                        if len(display_meta) > 0:
-                            display_meta = display_meta[0]
-                        else:
-                            display_meta = ""
-                else:
-                    display_meta = ""
-                yield Completion(word, -len(word_before_cursor),
-                                 display_meta=display_meta)
+        if self.match_middle:
+            words = [word for word in self.words.keys() if word_matches(word)]
+        else:
+            words = self.index.complete(word_before_cursor)
+        for word in words:
+            if self.include_docstr:
+                display_meta = self.words[word]
+                if self.trim_docstr:
+                    display_meta = display_meta.strip().split("\n")
+                    if len(display_meta) > 0:
+                        display_meta = display_meta[0]
+                    else:
+                        display_meta = ""
+            else:
+                display_meta = ""
+            yield Completion(word, -len(word_before_cursor),
+                             display_meta=display_meta)
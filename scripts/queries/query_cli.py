@@ -1,9 +1,15 @@
 
 import os
+import asyncio
 import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from prompt_class_completer import ClassCompleter
-from finder import Finder, ParseError
+import batch
+import connection
+from prompt_class_completer import ClassCompleter, ValueCache
+from finder import Finder, ParseError, QueryCancelled
+from offline import OfflineFinder
 from prompt_toolkit import prompt
 from prompt_toolkit.history import InMemoryHistory, FileHistory
 
@@ -11,11 +17,162 @@ from prompt_toolkit.history import InMemoryHistory, FileHistory
 def get_default_histfile():
     return os.path.join(os.path.expanduser('~'), '.cosycatcli_history')
 
+
+def get_default_cachefile():
+    return os.path.join(os.path.expanduser('~'), '.cosycatcli_cache')
+
+
+def get_default_slowlog():
+    return os.path.join(os.path.expanduser('~'), '.cosycatcli_slowlog')
+
+
+def get_default_rollupfile():
+    return os.path.join(os.path.expanduser('~'), '.cosycatcli_rollups.db')
+
+
+def get_default_textindexfile():
+    return os.path.join(os.path.expanduser('~'), '.cosycatcli_textindex.db')
+
+
+def get_default_snapshotdir():
+    return os.path.join(os.path.expanduser('~'), '.cosycatcli_snapshot')
+
+
+@contextmanager
+def reporting_errors():
+    """Report errors of a command to the user without leaving the session"""
+    try:
+        yield
+    except NotImplementedError:
+        print("Functionality is not yet implemented... :-(")
+    except ParseError as e:
+        print("Bad input [{value}], expected format is [{expected}]".
+              format(value=e.value, expected=e.expected))
+    except AssertionError as e:
+        print("Bad input value: {assertion}".format(assertion=e))
+    except ValueError as e:
+        print("Bad input value: {message}".format(message=e.args[0]))
+    except QueryCancelled:
+        print("Query cancelled")
+    except Exception as e:
+        print("Unrecognized error:")
+        print("\t" + traceback.format_exc().replace("\n", "\n\t"))
+
+
+def run_sync(finder, args, history, completer):
+    def recur(res):
+        if res:
+            for question, callback in res:
+                recur(callback(prompt(question + '\n')))
+
+    while True:
+        try:
+            text = prompt(
+                args.input_prompt, history=history, completer=completer)
+            if not text.split():            # skip whitespace input
+                continue
+            with reporting_errors():
+                recur(finder.parse(text))
+        except KeyboardInterrupt:
+            finder.do_exit(None)
+        except EOFError:
+            finder.do_exit(None)
+
+
+def run_async(finder, args, history, completer):
+    """
+    Prompt loop in which long-running commands (Finder.BACKGROUND_COMMANDS)
+    run one after another in a background thread, each on a fork of the
+    session, while the prompt stays responsive. Open-ended commands
+    (Finder.DETACHED_COMMANDS, e.g. `watch`) run on their own thread
+    instead. A progress indicator is shown in the bottom toolbar. Ctrl-C or
+    `cancel` cancel the running and queued commands, killing their
+    server-side operations; `cancel <command>` only those of a command
+    (e.g. `cancel watch`).
+    """
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.patch_stdout import patch_stdout
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    jobs = []                   # (text, forked finder, future)
+
+    def toolbar():
+        running = [(text, fork) for (text, fork, future) in jobs
+                   if not future.done()]
+        if not running:
+            return None
+        text, fork = running[0]
+        return "[{text}] projects {done}/{total}, rows {rows}{queued}".format(
+            text=text, queued=" (+%d more)" % (len(running) - 1)
+            if len(running) > 1 else "", **fork.progress)
+
+    def cancel(cmd=None):
+        for job in list(jobs):
+            text, fork, future = job
+            if cmd is not None and text.split()[0] != cmd:
+                continue
+            if not future.cancel():         # already running
+                with reporting_errors():
+                    fork.cancel()
+            jobs.remove(job)
+
+    def submit(cmd, fork, text):
+        if cmd not in Finder.DETACHED_COMMANDS:
+            return executor.submit(run_job, fork, text)
+        detached = ThreadPoolExecutor(max_workers=1)
+        future = detached.submit(run_job, fork, text)
+        detached.shutdown(wait=False)       # ends with the job
+        return future
+
+    def run_job(fork, text):
+        with reporting_errors():
+            fork.parse(text)
+
+    session = PromptSession(history=history, completer=completer,
+                            bottom_toolbar=toolbar, refresh_interval=0.5)
+
+    async def recur(res):
+        if res:
+            for question, callback in res:
+                await recur(callback(await session.prompt_async(
+                    question + '\n')))
+
+    async def loop():
+        while True:
+            jobs[:] = [job for job in jobs if not job[2].done()]
+            try:
+                text = await session.prompt_async(args.input_prompt)
+            except KeyboardInterrupt:
+                if jobs:
+                    cancel()
+                    continue
+                finder.do_exit(None)
+            except EOFError:
+                cancel()
+                finder.do_exit(None)
+            if not text.split():            # skip whitespace input
+                continue
+            cmd, *rest = text.split()
+            if cmd == 'cancel':
+                cancel(*rest[:1])
+            elif cmd in Finder.BACKGROUND_COMMANDS:
+                with reporting_errors():
+                    # tagging may ask the server its version
+                    fork = finder.fork(tag=True)
+                    jobs.append((text, fork, submit(cmd, fork, text)))
+            else:
+                with reporting_errors():
+                    await recur(finder.parse(text))
+
+    with patch_stdout():
+        asyncio.run(loop())
+
+
 if __name__ == '__main__':
     import argparse
     import getpass
     parser = argparse.ArgumentParser(description='Cosycat Query CLI')
-    parser.add_argument('host')
+    parser.add_argument('host', nargs='?', default='localhost')
     parser.add_argument('-H', '--history_file', default=get_default_histfile())
     parser.add_argument('-i', '--input_prompt', default='> ')
     parser.add_argument('-p', '--port', type=int, default=27017)
@@ -23,6 +180,41 @@ if __name__ == '__main__':
     parser.add_argument('-u', '--user')
     parser.add_argument('-P', '--password')
     parser.add_argument('-v', '--verbose', default=False, action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-t', '--project_timeout', type=float)
+    parser.add_argument('-c', '--cache', default=False, action='store_true')
+    parser.add_argument('-C', '--cache_file', nargs='?',
+                        const=get_default_cachefile(),
+                        help="Persist the result cache to a file")
+    parser.add_argument('-R', '--rollup_file', nargs='?',
+                        const=get_default_rollupfile(),
+                        help="Persist count rollups to a sqlite file")
+    parser.add_argument('-T', '--textindex_file', nargs='?',
+                        const=get_default_textindexfile(),
+                        help="Persist the trigram index to a sqlite file")
+    parser.add_argument('-S', '--slow_log', default=get_default_slowlog())
+    parser.add_argument('-s', '--snapshot_dir',
+                        default=get_default_snapshotdir(),
+                        help="Directory of the local snapshot")
+    parser.add_argument('-o', '--offline', default=False, action='store_true',
+                        help="Query the snapshot without connecting")
+    parser.add_argument('--max_pool_size', type=int,
+                        help="Maximum connections per server")
+    parser.add_argument('--server_selection_timeout', type=float,
+                        help="Seconds to wait for a suitable server")
+    parser.add_argument('--socket_timeout', type=float,
+                        help="Seconds before a network read fails")
+    parser.add_argument('--read_preference',
+                        help="e.g. secondaryPreferred to send queries to "
+                        "secondaries")
+    parser.add_argument('-a', '--async_mode', default=False,
+                        action='store_true',
+                        help="Run long commands in the background")
+    parser.add_argument('-b', '--batch',
+                        help="Run the commands in a file ('-' for stdin) "
+                        "and exit")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help="Batch commands writing to files run at once")
     args = parser.parse_args()
 
     if args.user and not args.password:
@@ -43,39 +235,40 @@ if __name__ == '__main__':
             port=args.port,
             db=args.db)
 
-    finder = Finder(uri, args.db, verbose=args.verbose)
+    config = {'workers': args.workers,
+              'project_timeout': args.project_timeout,
+              'cache': args.cache}
+    if args.offline:
+        finder = OfflineFinder(args.snapshot_dir, verbose=args.verbose,
+                               config=config, slow_log=args.slow_log)
+    else:
+        finder = Finder(
+            uri, args.db, verbose=args.verbose, config=config,
+            cache_file=args.cache_file,
+            rollup_file=args.rollup_file,
+            textindex_file=args.textindex_file,
+            snapshot_dir=args.snapshot_dir,
+            slow_log=args.slow_log,
+            **connection.client_options(
+                max_pool_size=args.max_pool_size,
+                server_selection_timeout=args.server_selection_timeout,
+                socket_timeout=args.socket_timeout,
+                read_preference=args.read_preference))
+    if args.batch:
+        import sys
+        with (sys.stdin if args.batch == '-' else open(args.batch)) as f:
+            sys.exit(batch.run_script(finder, f, jobs=args.jobs))
+
     try:
         history = FileHistory(args.history_file)
     except Exception:
         print("Couldn't read input history. Using in-memory backend instead.")
         history = InMemoryHistory()
-    completer = ClassCompleter(Finder, prefix='do_')
+    values = ValueCache(finder.get_project_names, finder.field_values)
+    completer = ClassCompleter(Finder, prefix='do_', values=values,
+                               project_args=Finder.PROJECT_ARGS)
 
-    def recur(res):
-        if res:
-            for question, callback in res:
-                recur(callback(prompt(question + '\n')))
-
-    while True:
-        try:
-            text = prompt(
-                args.input_prompt, history=history, completer=completer)
-            if not text.split():            # skip whitespace input
-                continue
-            recur(finder.parse(text))
-        except KeyboardInterrupt:
-            finder.do_exit(None)
-        except EOFError:
-            finder.do_exit(None)
-        except NotImplementedError:
-            print("Functionality is not yet implemented... :-(")
-        except ParseError as e:
-            print("Bad input [{value}], expected format is [{expected}]".
-                  format(value=e.value, expected=e.expected))
-        except AssertionError as e:
-            print("Bad input value: {assertion}".format(assertion=e))
-        except ValueError as e:
-            print("Bad input value: {message}".format(message=e.args[0]))
-        except Exception as e:
-            print("Unrecognized error:")
-            print("\t" + traceback.format_exc().replace("\n", "\n\t"))
+    if args.async_mode:
+        run_async(finder, args, history, completer)
+    else:
+        run_sync(finder, args, history, completer)
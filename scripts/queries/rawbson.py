@@ -0,0 +1,49 @@
+import bson
+
+__all__ = (
+    'doc_tuples',
+    'raw_pipeline',
+    'raw_tuples'
+)
+
+
+def column_names(fields):
+    """Top-level names standing for (possibly dotted) fields in the output"""
+    return ['c%d' % i for i in range(len(fields))]
+
+
+def raw_pipeline(filters, sort, fields):
+    """
+    Aggregation pipeline returning the matching annotations as flat
+    documents with a top-level value per requested field (see
+    `column_names`). The server resolves dotted fields, so the client
+    never decodes (or builds dicts for) the enclosing subdocuments.
+    """
+    projection = {"_id": 0}
+    for name, field in zip(column_names(fields), fields):
+        projection[name] = "$" + field
+    pipeline = [{"$match": filters}]
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+    pipeline.append({"$project": projection})
+    return pipeline
+
+
+def raw_tuples(batches, fields):
+    """
+    Rows of values in field order from the raw BSON batches of a cursor
+    over `raw_pipeline` (e.g. `Collection.aggregate_raw_batches`). Each
+    batch is decoded at once by the C extension, and only one batch is
+    held in memory.
+    """
+    names = column_names(fields)
+    for batch in batches:
+        for doc in bson.decode_all(batch):
+            yield tuple(doc.get(name) for name in names)
+
+
+def doc_tuples(docs, fields):
+    """Like `raw_tuples` for decoded documents of a `raw_pipeline` cursor"""
+    names = column_names(fields)
+    for doc in docs:
+        yield tuple(doc.get(name) for name in names)
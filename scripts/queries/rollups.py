@@ -0,0 +1,203 @@
+import time
+import sqlite3
+import threading
+from datetime import datetime
+
+__all__ = (
+    'Rollups',
+    'ROLLUP_KEYS'
+)
+
+# Annotation fields kept in the rollups: field -> column name
+ROLLUP_KEYS = {'username': 'username',
+               'corpus': 'corpus',
+               'ann.key': 'ann_key'}
+
+# Documents fetched per round trip when refreshing
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+  project TEXT, id TEXT, username TEXT, corpus TEXT, ann_key TEXT, day TEXT,
+  PRIMARY KEY (project, id));
+CREATE TABLE IF NOT EXISTS rollups (
+  project TEXT, username TEXT, corpus TEXT, ann_key TEXT, day TEXT,
+  count INTEGER,
+  PRIMARY KEY (project, username, corpus, ann_key, day));
+CREATE TABLE IF NOT EXISTS checkpoints (
+  project TEXT PRIMARY KEY, timestamp INTEGER);
+"""
+
+
+def get_day(timestamp):
+    if timestamp is None:
+        return ''
+    return datetime.utcfromtimestamp(timestamp / 1000).strftime('%Y-%m-%d')
+
+
+def doc_key(doc):
+    """Rollup cell of an annotation. Missing values are stored as ''"""
+    ann = doc.get('ann') or {}
+    return (doc.get('username') or '', doc.get('corpus') or '',
+            ann.get('key') or '', get_day(doc.get('timestamp')))
+
+
+class Rollups(object):
+    """
+    Pre-aggregated annotation counts per (project, username, corpus,
+    ann.key, day), stored in a local sqlite database.
+
+    Rollups are refreshed incrementally: only annotations with a `timestamp`
+    at or after the last checkpoint are read (inserts and updates both set
+    the timestamp). The rollup cell of each annotation is tracked, so that
+    an update moves its count from the old cell to the new one. Removals
+    don't leave a trace in the annotation collection, so if the number of
+    tracked annotations no longer matches the collection, the project is
+    rebuilt from scratch. Refreshes can be rate-limited with `max_age`,
+    since each one runs a query per project.
+
+    :param path: sqlite file, defaults to an in-memory database.
+    """
+    def __init__(self, path=':memory:'):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.refreshed_at = {}  # project -> time of its last refresh
+
+    def _add(self, project_name, key, n):
+        self.db.execute(
+            "INSERT OR IGNORE INTO rollups VALUES (?, ?, ?, ?, ?, 0)",
+            (project_name,) + key)
+        cell = "project = ? AND username = ? AND corpus = ? AND " \
+            "ann_key = ? AND day = ?"
+        self.db.execute("UPDATE rollups SET count = count + ? WHERE " + cell,
+                        (n, project_name) + key)
+        self.db.execute("DELETE FROM rollups WHERE count <= 0 AND " + cell,
+                        (project_name,) + key)
+
+    def _tracked(self, project_name):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM docs WHERE project = ?",
+            (project_name,)).fetchone()[0]
+
+    def _checkpoint(self, project_name):
+        row = self.db.execute(
+            "SELECT timestamp FROM checkpoints WHERE project = ?",
+            (project_name,)).fetchone()
+        return row[0] if row else None
+
+    def _drop(self, project_name):
+        for table in ('docs', 'rollups', 'checkpoints'):
+            self.db.execute(
+                "DELETE FROM %s WHERE project = ?" % table, (project_name,))
+
+    def _scan(self, coll, project_name, since=None):
+        query = {} if since is None else {'timestamp': {'$gte': since}}
+        cursor = coll.find(
+            query, batch_size=BATCH_SIZE,
+            projection={'username': 1, 'corpus': 1, 'ann.key': 1,
+                        'timestamp': 1})
+        last, changed = since, 0
+        for doc in cursor:
+            doc_id, key = str(doc['_id']), doc_key(doc)
+            old = self.db.execute(
+                "SELECT username, corpus, ann_key, day FROM docs "
+                "WHERE project = ? AND id = ?",
+                (project_name, doc_id)).fetchone()
+            if old is not None and tuple(old) == key:
+                continue
+            if old is not None:
+                self._add(project_name, tuple(old), -1)
+            self._add(project_name, key, 1)
+            self.db.execute(
+                "INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                (project_name, doc_id) + key)
+            changed += 1
+            timestamp = doc.get('timestamp')
+            if timestamp is not None and (last is None or timestamp > last):
+                last = timestamp
+        self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)",
+                        (project_name, last))
+        return changed
+
+    def refresh(self, coll, project_name, max_age=None):
+        """
+        Bring the rollups of a project up to date with its collection.
+        Returns the number of annotations read that changed the rollups.
+        With `max_age`, rollups refreshed less than `max_age` seconds ago
+        are left as they are.
+        """
+        with self.lock, self.db:
+            refreshed_at = self.refreshed_at.get(project_name)
+            if max_age is not None and refreshed_at is not None and \
+               time.time() - refreshed_at < max_age:
+                return 0
+            checkpoint = self._checkpoint(project_name)
+            changed = 0
+            if checkpoint is not None:
+                changed = self._scan(coll, project_name, since=checkpoint)
+            if checkpoint is None or \
+               self._tracked(project_name) != coll.estimated_document_count():
+                self._drop(project_name)
+                changed = self._scan(coll, project_name)
+            # only once scanned: a failed scan is rolled back and retried
+            self.refreshed_at[project_name] = time.time()
+            return changed
+
+    def drop(self, project_name):
+        with self.lock, self.db:
+            self._drop(project_name)
+            self.refreshed_at.pop(project_name, None)
+
+    def status(self):
+        """Return a row per project with tracked annotations and checkpoint"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT c.project, c.timestamp, "
+                "(SELECT COUNT(*) FROM docs d WHERE d.project = c.project), "
+                "(SELECT COUNT(*) FROM rollups r WHERE r.project = c.project) "
+                "FROM checkpoints c ORDER BY c.project").fetchall()
+        return [{'project': p, 'checkpoint': t, 'annotations': n, 'cells': c}
+                for (p, t, n, c) in rows]
+
+    def supports(self, groupkeys, filters):
+        """
+        True if a query can be answered from the rollups: groupby and filter
+        keys must be rolled up and filter values can't be regexes.
+        """
+        if any(key not in ROLLUP_KEYS for key in groupkeys or []):
+            return False
+        for key, values in filters.items():
+            if key not in ROLLUP_KEYS:
+                return False
+            if any(v.startswith('/') and v.endswith('/') for v in values):
+                return False
+        return True
+
+    def counts(self, project_name, groupkeys, filters):
+        """
+        Answer a count query from the rollups, in the same format as
+        `Finder.groupcounts` (or a single count if no groupkeys are given).
+        """
+        columns = [ROLLUP_KEYS[key] for key in groupkeys or []]
+        where, params = ["project = ?"], [project_name]
+        for key, values in filters.items():
+            where.append("{col} IN ({vals})".format(
+                col=ROLLUP_KEYS[key], vals=", ".join("?" * len(values))))
+            params.extend(values)
+        sql = "SELECT {cols} SUM(count) FROM rollups WHERE {where}".format(
+            cols="".join(col + ", " for col in columns),
+            where=" AND ".join(where))
+        if columns:
+            sql += " GROUP BY " + ", ".join(columns)
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        if not groupkeys:
+            return rows[0][-1] or 0
+        result = []
+        for row in rows:
+            row_dict = {'count': row[-1]}
+            for key, value in zip(groupkeys, row):
+                row_dict[key] = value if value != '' else None
+            result.append(row_dict)
+        return result
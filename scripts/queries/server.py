@@ -0,0 +1,268 @@
+import json
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import cache
+from finder import Finder, ParseError, DISPLAY_FIELDS
+
+__all__ = (
+    'QueryService',
+    'SingleFlight',
+    'make_server'
+)
+
+# Rows per chunk of streamed JSON Lines responses
+CHUNK_ROWS = 500
+
+# Annotations returned by `find` unless a limit is given
+FIND_LIMIT = 100
+
+
+class SingleFlight(object):
+    """
+    Runs concurrent calls with the same key only once: callers arriving
+    while a call is running wait for it and share its result (or error).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}         # key -> running call
+        self.stats = {'calls': 0, 'coalesced': 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'value': None,
+                        'error': None}
+                self.calls[key] = call
+                self.stats['calls'] += 1
+            else:
+                self.stats['coalesced'] += 1
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['value']
+        try:
+            call['value'] = fn()
+            return call['value']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+
+class QueryService(object):
+    """
+    Read-only queries over a Finder for many clients at once. Each request
+    runs on a fork of the finder (sharing its connection pool) with the
+    filters and sort criteria of the request, given as in the CLI:
+      /count?project=A,B&filter=corpus:x&filter=username:/^a/&groupby=ann.key
+      /find?project=A&fields=username,ann.value&sort=timestamp:asc&limit=10
+    Identical concurrent counts run a single query and counts are cached
+    until their collections change (see `cache.collection_signal`).
+
+    :param finder: Finder whose connection is shared by all requests.
+    :param cache_size: maximum number of cached counts.
+    :param cache_ttl: seconds after which a cached count expires.
+    """
+    def __init__(self, finder, cache_size=256, cache_ttl=300):
+        self.finder = finder
+        self.flight = SingleFlight()
+        self.cache = cache.ResultCache(size=cache_size, ttl=cache_ttl)
+
+    def session(self, params):
+        """Fork of the finder with the filters and sort of a request"""
+        session = self.finder.fork()
+        session.verbose = False
+        for arg in params.get('filter', []):
+            if ':' not in arg:
+                raise ParseError(arg, "filter=key:value")
+            key, value = arg.split(':', 1)
+            session.add_to_filter(key, value)
+        session.do_sort(params.get('sort', []))
+        return session
+
+    def project_names(self, session, params):
+        assert params.get('project'), \
+            "Specify a project (e.g. GET) or 'all' for all projects"
+        project = params['project'][-1]
+        if project == 'all':
+            return sorted(session.get_project_names())
+        return project.split(',')
+
+    def projects(self, params):
+        return {'projects': sorted(self.finder.get_project_names())}
+
+    def count(self, params):
+        """Counts per project, grouped by the `groupby` keys if given"""
+        session = self.session(params)
+        project_names = self.project_names(session, params)
+        groupkeys = None
+        if params.get('groupby'):
+            groupkeys = params['groupby'][-1].split(',')
+        key = cache.query_key(','.join(project_names),
+                              session.query_filters(), groupkeys,
+                              scope=session.cache_scope())
+
+        def run():
+            signal = [cache.collection_signal(session.get_project(p))
+                      for p in project_names]
+            result = self.cache.get(key, signal)
+            if result is None:
+                by_project, failed = session.count_projects(
+                    project_names, groupkeys, quiet=True)
+                result = {'counts': by_project,
+                          'failed': {p: str(e) for p, e in failed.items()}}
+                if not failed:
+                    self.cache.put(key, signal, result)
+            return result
+        return self.flight.do(key, run)
+
+    def find(self, params):
+        """Matching annotations of a project as rows (streamed)"""
+        session = self.session(params)
+        project_names = self.project_names(session, params)
+        assert len(project_names) == 1, "Specify a single project"
+        fields = list(DISPLAY_FIELDS)
+        if params.get('fields'):
+            fields = params['fields'][-1].split(',')
+        limit = FIND_LIMIT
+        if params.get('limit'):
+            limit = params['limit'][-1]
+            if not limit.isdigit():
+                raise ParseError(limit, "limit=<integer>, 0 for all")
+            limit = int(limit) or None
+        rows = session.annotation_tuples(project_names[0], fields, limit)
+        return (dict(zip(fields, row)) for row in rows)
+
+    def stats(self, params):
+        return {'cache': self.cache.stats, 'requests': self.flight.stats,
+                'pool': self.finder.pool.stats()}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """GET endpoints of a QueryService (set on the server as `service`)"""
+    protocol_version = 'HTTP/1.1'
+    # path -> (QueryService method, streamed as JSON Lines)
+    ROUTES = {'/projects': ('projects', False),
+              '/count': ('count', False),
+              '/find': ('find', True),
+              '/stats': ('stats', False)}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in self.ROUTES:
+            return self.send_json(404, {'error': 'Unknown path ' + url.path})
+        method, streamed = self.ROUTES[url.path]
+        params = parse_qs(url.query)
+        try:
+            result = getattr(self.server.service, method)(params)
+            if streamed:
+                # fail before the headers if the query can't start
+                rows = iter(result)
+                first = next(rows, None)
+        except ParseError as e:
+            return self.send_json(400, {'error': "Bad input [{value}], "
+                                        "expected format is [{expected}]".
+                                        format(value=e.value,
+                                               expected=e.expected)})
+        except (AssertionError, ValueError) as e:
+            return self.send_json(400, {'error': str(e)})
+        except Exception:
+            traceback.print_exc()
+            return self.send_json(500, {'error': 'Internal error'})
+        if not streamed:
+            return self.send_json(200, result)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        if first is not None:
+            self.stream_rows([first], rows)
+        self.write_chunk(b'')
+
+    def stream_rows(self, head, rows):
+        """Write rows as JSON Lines, CHUNK_ROWS per chunk"""
+        lines = []
+        for part in (head, rows):
+            for row in part:
+                lines.append(json.dumps(row, default=str))
+                if len(lines) >= CHUNK_ROWS:
+                    self.write_chunk(('\n'.join(lines) + '\n').encode())
+                    lines = []
+        if lines:
+            self.write_chunk(('\n'.join(lines) + '\n').encode())
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.service.finder.verbose:
+            super(Handler, self).log_message(format, *args)
+
+
+def make_server(finder, host='localhost', port=8080, **kwargs):
+    """
+    HTTP server answering requests concurrently (a thread each) from a
+    QueryService over `finder`, e.g. a Finder over mongomock in tests.
+    Call `serve_forever` to start it.
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = QueryService(finder, **kwargs)
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+    import connection
+    parser = argparse.ArgumentParser(description='Cosycat Query Service')
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=27017)
+    parser.add_argument('-d', '--db', type=str, default='cosycat')
+    parser.add_argument('-l', '--listen', default='localhost',
+                        help="Address to serve on")
+    parser.add_argument('-L', '--listen_port', type=int, default=8080)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-t', '--project_timeout', type=float)
+    parser.add_argument('--cache_ttl', type=float, default=300,
+                        help="Seconds before a cached count expires")
+    parser.add_argument('--max_pool_size', type=int,
+                        help="Maximum connections per server")
+    parser.add_argument('--read_preference',
+                        help="e.g. secondaryPreferred to send queries to "
+                        "secondaries")
+    parser.add_argument('-v', '--verbose', default=False, action='store_true')
+    args = parser.parse_args()
+
+    uri = 'mongodb://{host}:{port}/{db}'.format(
+        host=args.host, port=args.port, db=args.db)
+    finder = Finder(
+        uri, args.db, verbose=args.verbose,
+        config={'workers': args.workers,
+                'project_timeout': args.project_timeout},
+        **connection.client_options(max_pool_size=args.max_pool_size,
+                                    read_preference=args.read_preference))
+    server = make_server(finder, args.listen, args.listen_port,
+                         cache_ttl=args.cache_ttl)
+    print("Serving on http://{host}:{port}".format(
+        host=args.listen, port=args.listen_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
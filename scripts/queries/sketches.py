@@ -0,0 +1,83 @@
+import math
+import hashlib
+
+__all__ = (
+    'HyperLogLog',
+    'sample_estimate'
+)
+
+
+def hash64(value):
+    """Stable 64 bit hash of a value (python's hash() is salted per run)"""
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8') if isinstance(value, str) \
+            else repr(value).encode('utf-8')
+    return int.from_bytes(
+        hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch estimating the number of distinct values of a stream
+    in constant memory (2^p one-byte registers). Sketches with the same `p`
+    can be merged, e.g. to count distinct values across projects.
+
+    :param p: precision, number of hash bits used to pick a register.
+        The relative standard error is 1.04 / sqrt(2^p).
+    """
+    def __init__(self, p=14):
+        assert 4 <= p <= 18, "Precision must be in [4, 18]"
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        x = hash64(value)
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        """Merge other into this sketch, counting the union of both streams"""
+        assert self.p == other.p, "Can't merge sketches of different precision"
+        self.registers = bytearray(
+            max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / sum(
+            2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # small range correction (linear counting)
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def error(self):
+        """Relative standard error of the estimate"""
+        return 1.04 / math.sqrt(self.m)
+
+
+def sample_estimate(count, sample_size, total, z=1.96):
+    """
+    Scale a count observed in a uniform sample of `sample_size` out of
+    `total` documents to the whole collection. Returns the estimate and the
+    bounds of its confidence interval (normal approximation with finite
+    population correction, 95% for the default `z`).
+    """
+    if sample_size == 0:
+        return 0, 0, 0
+    p = count / sample_size
+    estimate = total * p
+    fpc = (total - sample_size) / (total - 1) if total > 1 else 0
+    margin = z * total * math.sqrt(p * (1 - p) / sample_size * fpc)
+    return (int(round(estimate)), max(0, int(estimate - margin)),
+            min(total, int(math.ceil(estimate + margin))))
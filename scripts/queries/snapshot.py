@@ -0,0 +1,254 @@
+import os
+import re
+import json
+import shutil
+import threading
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import writers
+
+__all__ = (
+    'Snapshot',
+    'filter_expression'
+)
+
+# Annotation fields kept in snapshots: column name -> arrow type name.
+# Columns are named after the (dotted) annotation keys, `Any` fields are
+# stored as strings and low-cardinality fields are dictionary-encoded.
+COLUMNS = [('_id', 'string'),
+           ('timestamp', 'int64'),
+           ('_version', 'int64'),
+           ('username', 'dictionary'),
+           ('corpus', 'dictionary'),
+           ('ann.key', 'dictionary'),
+           ('ann.value', 'string'),
+           ('query', 'string'),
+           ('hit-id', 'string'),
+           ('span.type', 'dictionary'),
+           ('span.doc', 'string'),
+           ('span.scope', 'int64'),
+           ('span.scope.B', 'int64'),
+           ('span.scope.O', 'int64')]
+
+# Documents per parquet row group when copying a collection
+BATCH_SIZE = 10000
+
+# Incremental parts per project above which they are compacted into one
+MAX_PARTS = 8
+
+
+def arrow_schema():
+    types = {'string': pyarrow.string(),
+             'int64': pyarrow.int64(),
+             'dictionary': pyarrow.dictionary(pyarrow.int32(),
+                                              pyarrow.string())}
+    return pyarrow.schema([(name, types[t]) for name, t in COLUMNS])
+
+
+def doc_row(doc):
+    """Flatten an annotation into a snapshot row"""
+    row = {}
+    for name, column_type in COLUMNS:
+        value = writers.get_in(doc, name)
+        if isinstance(value, dict):     # IOB scope under span.scope
+            value = None
+        if value is not None and column_type != 'int64':
+            value = str(value)
+        row[name] = value
+    return row
+
+
+def normalize(filters):
+    """Filters as stored in a JSON manifest"""
+    return json.loads(json.dumps(filters, default=str, sort_keys=True))
+
+
+def filter_expression(filters):
+    """
+    Arrow expression equivalent to the session filters (a dict from field
+    to values, `/regex/` values as in `Finder.query_filters`), or None.
+    """
+    expression = None
+    for key, values in filters.items():
+        assert key in dict(COLUMNS), "Field [%s] isn't in snapshots" % key
+        field = pyarrow.compute.field(key)
+        is_regex = len(values) == 1 and re.match(r"/([^/]+)/", values[0])
+        if is_regex:
+            if dict(COLUMNS)[key] == 'dictionary':
+                field = field.cast(pyarrow.string())
+            clause = pyarrow.compute.match_substring_regex(
+                field, is_regex.groups()[0])
+        elif dict(COLUMNS)[key] == 'int64':
+            clause = field.isin([int(value) for value in values])
+        else:
+            clause = field.isin(values)
+        expression = clause if expression is None else expression & clause
+    return expression
+
+
+class Snapshot(object):
+    """
+    Local columnar copy of the project collections, one directory of
+    parquet files per project.
+
+    The first snapshot of a project copies all its (matching) annotations,
+    later ones only those with a `timestamp` at or after the last copied
+    one (inserts and updates both set the timestamp), written as a new
+    part. Reading a project keeps the most recent copy of each annotation.
+    If the number of annotations no longer matches the collection (e.g.
+    after removals) or the filters changed, the project is copied again.
+
+    :param path: directory of the snapshot.
+    """
+    def __init__(self, path):
+        if pyarrow is None:
+            raise ValueError("Snapshots require pyarrow")
+        self.path = path
+        self.lock = threading.Lock()
+        self.tables = {}        # project -> deduplicated table
+
+    def project_path(self, project_name, *parts):
+        return os.path.join(self.path, project_name, *parts)
+
+    def manifest(self, project_name):
+        try:
+            with open(self.project_path(project_name, 'manifest.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_manifest(self, project_name, manifest):
+        with open(self.project_path(project_name, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def project_names(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if self.manifest(name) is not None)
+
+    def _copy(self, coll, project_name, query, part):
+        """Copy the documents matching `query` into a new parquet part"""
+        schema, writer, last, rows = arrow_schema(), None, None, []
+        outfile = self.project_path(project_name, 'part-%05d.parquet' % part)
+        copied = 0
+        try:
+            for doc in coll.find(query, batch_size=BATCH_SIZE):
+                rows.append(doc_row(doc))
+                timestamp = doc.get('timestamp')
+                if timestamp is not None and \
+                   (last is None or timestamp > last):
+                    last = timestamp
+                if len(rows) < BATCH_SIZE:
+                    continue
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(outfile, schema)
+                writer.write_table(pyarrow.Table.from_pylist(rows, schema))
+                copied, rows = copied + len(rows), []
+            if rows or writer is None:
+                writer = writer or pyarrow.parquet.ParquetWriter(
+                    outfile, schema)
+                writer.write_table(pyarrow.Table.from_pylist(rows, schema))
+                copied += len(rows)
+        finally:
+            if writer is not None:
+                writer.close()
+        return copied, last
+
+    def refresh(self, coll, project_name, filters, rebuild=False):
+        """
+        Bring the snapshot of a project up to date with its collection,
+        restricted to `filters` (a pymongo query). Returns the number of
+        annotations copied.
+        """
+        manifest = self.manifest(project_name)
+        if manifest is not None and manifest['filters'] != normalize(filters):
+            manifest = None     # a different selection, copy it again
+        if manifest is None or rebuild:
+            self.drop(project_name)
+            os.makedirs(self.project_path(project_name))
+            manifest = {'filters': normalize(filters), 'parts': [],
+                        'checkpoint': None}
+        query = dict(filters)
+        if manifest['checkpoint'] is not None:
+            query = {"$and": [filters, {"timestamp": {
+                "$gte": manifest['checkpoint']}}]}
+        part = len(manifest['parts'])
+        copied, last = self._copy(coll, project_name, query, part)
+        manifest['parts'].append('part-%05d.parquet' % part)
+        if last is not None:
+            manifest['checkpoint'] = max(last, manifest['checkpoint'] or last)
+        self._write_manifest(project_name, manifest)
+
+        with self.lock:
+            self.tables.pop(project_name, None)
+        if part > 0 and not rebuild and \
+           self.table(project_name).num_rows != coll.count_documents(filters):
+            # annotations were removed, copy the project from scratch
+            return self.refresh(coll, project_name, filters, rebuild=True)
+        if len(manifest['parts']) > MAX_PARTS:
+            self.compact(project_name)
+        return copied
+
+    def compact(self, project_name):
+        """Rewrite the parts of a project as a single deduplicated part"""
+        manifest = self.manifest(project_name)
+        table = self.table(project_name)
+        pyarrow.parquet.write_table(
+            table, self.project_path(project_name, 'compact.parquet'))
+        for part in manifest['parts']:
+            os.remove(self.project_path(project_name, part))
+        os.rename(self.project_path(project_name, 'compact.parquet'),
+                  self.project_path(project_name, 'part-00000.parquet'))
+        manifest['parts'] = ['part-00000.parquet']
+        self._write_manifest(project_name, manifest)
+
+    def drop(self, project_name):
+        shutil.rmtree(self.project_path(project_name), ignore_errors=True)
+        with self.lock:
+            self.tables.pop(project_name, None)
+
+    def table(self, project_name):
+        """
+        Arrow table of a project, keeping the most recent copy of each
+        annotation (parts are read newest first). Tables are kept in memory
+        until the project is refreshed.
+        """
+        with self.lock:
+            if project_name in self.tables:
+                return self.tables[project_name]
+        manifest = self.manifest(project_name)
+        assert manifest is not None, \
+            "No snapshot of project [%s]" % project_name
+        tables, seen = [], None
+        for part in reversed(manifest['parts']):
+            table = pyarrow.parquet.read_table(
+                self.project_path(project_name, part))
+            if seen is not None:
+                table = table.filter(pyarrow.compute.invert(
+                    pyarrow.compute.is_in(table['_id'], value_set=seen)))
+                seen = pyarrow.concat_arrays(
+                    [seen, table['_id'].combine_chunks()])
+            else:
+                seen = table['_id'].combine_chunks()
+            tables.append(table)
+        table = pyarrow.concat_tables(tables).unify_dictionaries()
+        with self.lock:
+            self.tables[project_name] = table
+        return table
+
+    def status(self):
+        rows = []
+        for project_name in self.project_names():
+            manifest = self.manifest(project_name)
+            rows.append({'project': project_name,
+                         'parts': len(manifest['parts']),
+                         'checkpoint': manifest['checkpoint'],
+                         'annotations': self.table(project_name).num_rows})
+        return rows
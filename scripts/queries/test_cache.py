@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import cache
+from finder import Finder
+
+
+class QueryKeyTest(unittest.TestCase):
+    def test_normalizes_filters(self):
+        self.assertEqual(
+            cache.query_key('_A', {'a': ['1'], 'b': ['2']}, ['username']),
+            cache.query_key('_A', {'b': ['2'], 'a': ['1']}, ['username']))
+
+    def test_scope(self):
+        self.assertNotEqual(
+            cache.query_key('_A', {}, scope=['mongodb://h1', 'cosycat']),
+            cache.query_key('_A', {}, scope=['mongodb://h2', 'cosycat']))
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class SharedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.client = mongomock.MongoClient()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def finder(self, db, username):
+        self.client[db]['_A'].insert_many(
+            [{'username': username} for _ in range(10)])
+        finder = Finder('mongodb://user:pw@localhost:27017/' + db, db,
+                        verbose=False, client=self.client,
+                        config={'cache': True},
+                        cache_file=os.path.join(self.dir, 'cache'))
+        finder.add_to_filter('username', '/./')
+        return finder
+
+    def counts(self, finder):
+        by_project, _ = finder.count_projects(['A'], ['username'],
+                                              quiet=True)
+        finder.cache.close()
+        return {row['username']: row['count'] for row in by_project['A']}
+
+    def test_databases_dont_share_entries(self):
+        self.assertEqual(self.counts(self.finder('first', 'x')), {'x': 10})
+        self.assertEqual(self.counts(self.finder('second', 'y')), {'y': 10})
+        first = self.finder('first', 'x')
+        self.assertEqual(first.cache_scope(),
+                         ['mongodb://localhost:27017', 'first'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+from pymongo.errors import AutoReconnect
+
+import rollups
+
+
+def annotations(n):
+    return [{'_id': i, 'username': ['x', 'y'][i % 2], 'corpus': 'c',
+             'ann': {'key': 'pos'}, 'timestamp': 1500000000000 + i}
+            for i in range(n)]
+
+
+class FailingCollection(object):
+    """Collection whose first `failures` finds raise AutoReconnect"""
+    def __init__(self, coll, failures=1):
+        self.coll = coll
+        self.failures = failures
+
+    def find(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect('connection reset')
+        return self.coll.find(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.coll, name)
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.coll = mongomock.MongoClient()['cosycat']['_A']
+        self.coll.insert_many(annotations(10))
+        self.rollups = rollups.Rollups()
+
+    def counts(self):
+        return {row['username']: row['count'] for row in
+                self.rollups.counts('A', ['username'], {})}
+
+    def test_refresh_is_rate_limited(self):
+        self.assertEqual(self.rollups.refresh(self.coll, 'A', max_age=60), 10)
+        self.coll.insert_one({'_id': 10, 'username': 'x',
+                              'timestamp': 1600000000000})
+        self.assertEqual(self.rollups.refresh(self.coll, 'A', max_age=60), 0)
+        self.assertEqual(self.counts(), {'x': 5, 'y': 5})
+        self.assertEqual(self.rollups.refresh(self.coll, 'A'), 1)
+        self.assertEqual(self.counts(), {'x': 6, 'y': 5})
+
+    def test_failed_refresh_is_retried(self):
+        failing = FailingCollection(self.coll)
+        with self.assertRaises(AutoReconnect):
+            self.rollups.refresh(failing, 'A', max_age=60)
+        self.assertEqual(self.rollups.status(), [])
+        self.assertEqual(self.rollups.refresh(failing, 'A', max_age=60), 10)
+        self.assertEqual(self.counts(), {'x': 5, 'y': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import json
+import time
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import server
+from finder import Finder
+
+
+def annotations(project, n):
+    return [{'_id': '%s%d' % (project, i),
+             'username': ['x', 'y'][i % 2],
+             'corpus': ['c1', 'c2'][i % 3 == 0],
+             'timestamp': 1500000000000 + i,
+             '_version': 0,
+             'ann': {'key': 'pos', 'value': 'N'},
+             'span': {'type': 'token', 'scope': i, 'doc': 'd%d' % (i // 10)}}
+            for i in range(n)]
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_coalesces_concurrent_calls(self):
+        flight, calls, release = server.SingleFlight(), [], threading.Event()
+
+        def slow():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(flight.do('key', slow)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flight.stats['coalesced'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(flight.stats, {'calls': 1, 'coalesced': 4})
+
+    def test_shares_errors_and_forgets_finished_calls(self):
+        flight = server.SingleFlight()
+
+        def fail():
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            flight.do('key', fail)
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.calls, {})
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.finder = Finder('mongodb://mock', 'cosycat', verbose=False,
+                             client=mongomock.MongoClient())
+        self.finder.conn['_A'].insert_many(annotations('A', 30))
+        self.finder.conn['_B'].insert_many(annotations('B', 20))
+        self.server = server.make_server(self.finder, 'localhost', 0)
+        self.service = self.server.service
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        url = 'http://localhost:%d%s' % (self.port, path)
+        with urllib.request.urlopen(url) as response:
+            return response, response.read().decode()
+
+    def get_error(self, path):
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            self.get(path)
+        return error.exception.code, json.loads(error.exception.read())
+
+    def test_projects(self):
+        _, body = self.get('/projects')
+        self.assertEqual(json.loads(body), {'projects': ['A', 'B']})
+
+    def test_count(self):
+        _, body = self.get('/count?project=all&filter=username:x')
+        self.assertEqual(json.loads(body),
+                         {'counts': {'A': 15, 'B': 10}, 'failed': {}})
+        _, body = self.get('/count?project=A&groupby=username'
+                           '&filter=corpus:c1')
+        counts = json.loads(body)['counts']['A']
+        self.assertEqual(sorted((r['username'], r['count']) for r in counts),
+                         [('x', 10), ('y', 10)])
+
+    def test_count_cache_invalidation(self):
+        params = {'project': ['A'], 'groupby': ['username']}
+        first = self.service.count(params)
+        self.assertEqual(self.service.cache.stats['misses'], 1)
+        self.assertEqual(self.service.count(params), first)
+        self.assertEqual(self.service.cache.stats['hits'], 1)
+        self.finder.conn['_A'].insert_one(
+            {'_id': 'new', 'username': 'x', 'timestamp': 1600000000000})
+        counts = self.service.count(params)['counts']['A']
+        self.assertEqual(self.service.cache.stats['invalidated'], 1)
+        self.assertEqual({r['username']: r['count'] for r in counts},
+                         {'x': 16, 'y': 15})
+
+    def test_find_streams_json_lines(self):
+        response, body = self.get('/find?project=A&fields=_id,ann.key'
+                                  '&filter=username:y&sort=timestamp:asc'
+                                  '&limit=0')
+        self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(len(rows), 15)
+        self.assertEqual(rows[0], {'_id': 'A1', 'ann.key': 'pos'})
+        _, body = self.get('/find?project=A&limit=3')
+        self.assertEqual(len(body.splitlines()), 3)
+
+    def test_errors(self):
+        self.assertEqual(self.get_error('/nope')[0], 404)
+        self.assertEqual(self.get_error('/count')[0], 400)
+        self.assertEqual(self.get_error('/find?project=A,B')[0], 400)
+        self.assertEqual(self.get_error('/find?project=A&limit=x')[0], 400)
+        self.assertEqual(self.get_error('/count?project=A&filter=bad')[0],
+                         400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import textindex
+from textindex import prefix_filter, required_trigrams
+
+
+class PrefixFilterTest(unittest.TestCase):
+    def test_literals(self):
+        self.assertEqual(prefix_filter('^abc$'), 'abc')
+        self.assertEqual(prefix_filter('^abc'), {'$gte': 'abc', '$lt': 'abd'})
+        self.assertEqual(prefix_filter(r'^a\.b$'), 'a.b')
+
+    def test_narrowed_regex(self):
+        for pattern, prefix in [('^abc.*d', 'abc'), ('^abc+', 'abc'),
+                                ('^abc?d', 'ab'), ('^ab(cd)?e', 'ab'),
+                                ('^ab(cd)e', 'ab'), ('^ab[cd]', 'ab'),
+                                (r'^ab\d{2}', 'ab'), ('^abc{2}', 'ab')]:
+            self.assertEqual(
+                prefix_filter(pattern),
+                {'$gte': prefix, '$lt': prefix[:-1] + chr(ord(prefix[-1]) + 1),
+                 '$regex': pattern}, pattern)
+
+    def test_escapes(self):
+        for pattern in [r'^ab\x41cd', r'^ab\101cd', r'^ab\x{41}cd',
+                        r'^ab\cMcd', r'^ab\1cd', r'^ab\k<n>cd']:
+            self.assertEqual(prefix_filter(pattern)['$gte'], 'ab', pattern)
+            self.assertEqual(prefix_filter(pattern)['$regex'], pattern)
+
+    def test_no_prefix(self):
+        for pattern in ['abc', '^.abc', '^a*bc', '^(ab)', '^ab|cd',
+                        '(?i)^ab', r'^\Qab\E', r'^\x41bc', '^']:
+            self.assertIsNone(prefix_filter(pattern), pattern)
+
+
+class RequiredTrigramsTest(unittest.TestCase):
+    def test_literal_runs(self):
+        self.assertEqual(required_trigrams('abcd'), {'abc', 'bcd'})
+        self.assertEqual(required_trigrams('^abc$'), {'abc'})
+        self.assertEqual(required_trigrams('ab.cde'), {'cde'})
+        self.assertEqual(required_trigrams(r'a\.bc'), {'a.b', '.bc'})
+
+    def test_quantifiers_and_groups(self):
+        self.assertEqual(required_trigrams('abcd*e'), {'abc'})
+        self.assertEqual(required_trigrams('abc+de'), {'abc'})
+        self.assertEqual(required_trigrams('abc{2}def'), {'def'})
+        self.assertEqual(required_trigrams('x(abc)?yzw'), {'yzw'})
+        self.assertEqual(required_trigrams('(abcd)'), {'abc', 'bcd'})
+        self.assertEqual(required_trigrams('ab[cd]ef'), set())
+
+    def test_escapes(self):
+        self.assertEqual(required_trigrams(r'foo\x41bar'), {'foo', 'bar'})
+        self.assertEqual(required_trigrams(r'foo\101bar'), {'foo', 'bar'})
+        self.assertEqual(required_trigrams(r'(a)foo\1bar'), {'foo', 'bar'})
+        self.assertEqual(required_trigrams(r'foo\d{3}bar'), {'foo', 'bar'})
+
+    def test_not_plain(self):
+        for pattern in ['abc|def', '(?i)abc', r'\Qabc\E']:
+            self.assertEqual(required_trigrams(pattern), set(), pattern)
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class CandidatesTest(unittest.TestCase):
+    def setUp(self):
+        coll = mongomock.MongoClient()['cosycat']['_A']
+        coll.insert_many([{'query': q, 'timestamp': i} for i, q in enumerate(
+            ['fooAbar', 'fooBbar', 'foobar', 'barfoo', '[word="a"]'])])
+        self.index = textindex.TrigramIndex()
+        self.assertEqual(self.index.build(coll, 'A', 'query'), 5)
+
+    def test_candidates(self):
+        for pattern, values in [
+                ('foo', ['barfoo', 'fooAbar', 'fooBbar', 'foobar']),
+                (r'foo\x41bar', ['fooAbar']),
+                (r'foo\101bar', ['fooAbar']),
+                ('foo.bar', ['fooAbar', 'fooBbar']),
+                ('^foo[AB]', ['fooAbar', 'fooBbar']),
+                ('bar$', ['fooAbar', 'fooBbar', 'foobar']),
+                ('^foobar$', ['foobar']),
+                ('o+b', ['foobar']),
+                ('foo|word', ['[word="a"]', 'barfoo', 'fooAbar', 'fooBbar',
+                              'foobar']),
+                (r'word="a"\]', ['[word="a"]']),
+                ('nothing', [])]:
+            self.assertEqual(self.index.candidates('query', pattern), values,
+                             pattern)
+        self.assertIsNone(self.index.candidates('query', '(unclosed'))
+
+    def test_built_at(self):
+        self.assertEqual(self.index.built_at('query', ['A']), 4)
+        self.assertIsNone(self.index.built_at('query', ['A', 'B']))
+
+
+if __name__ == '__main__':
+    unittest.main()
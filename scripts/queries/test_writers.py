@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import writers
+
+
+@unittest.skipIf(pyarrow is None, "requires pyarrow")
+class ParquetTest(unittest.TestCase):
+    header = ['hit-id', 'value', 'count']
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.dir, 'out.parquet')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, rows, chunk_size=2):
+        writers.parquet_tuples(rows, self.header, self.outfile,
+                               chunk_size=chunk_size)
+        table = pyarrow.parquet.read_table(self.outfile)
+        return ([str(t) for t in table.schema.types],
+                [tuple(row.values()) for row in table.to_pylist()])
+
+    def test_typed_columns(self):
+        rows = [(1, 'a', 10), (2, 'b', None), (3, None, 30)]
+        self.assertEqual(self.write(rows),
+                         (['int64', 'string', 'int64'], rows))
+
+    def test_mixed_types_in_a_chunk(self):
+        self.assertEqual(self.write([(1, 'a', 1), ('x', {'k': 1}, 2)]),
+                         (['string', 'string', 'int64'],
+                          [('1', 'a', 1), ('x', '{"k": 1}', 2)]))
+
+    def test_type_change_across_chunks(self):
+        rows = [(1, 'a', 1), (2, 'b', 2), ('x', 'c', 3), (4, 5, 4.5)]
+        self.assertEqual(self.write(rows),
+                         (['string', 'string', 'string'],
+                          [('1', 'a', '1'), ('2', 'b', '2'),
+                           ('x', 'c', '3'), ('4', '5', '4.5')]))
+
+    def test_struct_change_across_chunks(self):
+        rows = [(1, {'a': 1}, 1), (2, {'b': 2}, 2)]
+        self.assertEqual(self.write(rows, 1),
+                         (['int64', 'string', 'int64'],
+                          [(1, '{"a": 1}', 1), (2, '{"b": 2}', 2)]))
+
+    def test_columns_without_values(self):
+        self.assertEqual(self.write([(1, None, None), (2, None, 3)], 1),
+                         (['int64', 'string', 'string'],
+                          [(1, None, None), (2, None, '3')]))
+
+    def test_no_rows(self):
+        self.assertEqual(self.write([]), (['string'] * 3, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+import re
+import sqlite3
+import threading
+from itertools import takewhile
+
+__all__ = (
+    'TrigramIndex',
+    'prefix_filter',
+    'required_trigrams',
+    'TEXT_FIELDS'
+)
+
+# Fields indexed by default (long CQL strings and annotation values)
+TEXT_FIELDS = ('query', 'ann.value')
+
+# Above this many candidate values the $in list isn't worth sending
+MAX_CANDIDATES = 5000
+
+# Regex characters making the preceding character (or group) optional
+OPTIONAL = ('*', '?', '{')
+
+# Token of an end anchor ($) in a tokenized regex
+END = object()
+
+# Escapes followed by a fixed number of characters, e.g. \x41 or \cM
+ESCAPE_ARGS = {'x': 2, 'u': 4, 'U': 8, 'c': 1, 'p': 1, 'P': 1}
+
+# Escapes which may take a delimited argument (e.g. \x{41}, \k<name>)
+ESCAPE_BRACKETS = {'{': '}', '<': '>'}
+BRACKETED = set('xuNpPgk')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS terms (
+  project TEXT, field TEXT, value TEXT,
+  PRIMARY KEY (project, field, value));
+CREATE TABLE IF NOT EXISTS grams (
+  project TEXT, field TEXT, gram TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS grams_gram ON grams (field, gram);
+CREATE TABLE IF NOT EXISTS builds (
+  project TEXT, field TEXT, built_at INTEGER, terms INTEGER,
+  PRIMARY KEY (project, field));
+"""
+
+
+def escape_end(pattern, i):
+    """
+    Index after the alphanumeric escape starting at `pattern[i]` (a
+    backslash): its digits for octal escapes and backreferences, or its
+    argument for escapes such as \\xHH, \\x{H..}, \\cX or \\k<name>.
+    """
+    c, i = pattern[i + 1], i + 2
+    if c.isdigit():
+        while i < len(pattern) and pattern[i].isdigit():
+            i += 1
+        return i
+    if c in BRACKETED and i < len(pattern) and \
+       pattern[i] in ESCAPE_BRACKETS:
+        end = pattern.find(ESCAPE_BRACKETS[pattern[i]], i)
+        return len(pattern) if end == -1 else end + 1
+    return min(i + ESCAPE_ARGS.get(c, 0), len(pattern))
+
+
+def tokenize(pattern):
+    """
+    Split a regex into its literal characters and None for everything that
+    doesn't match one fixed character (classes, escapes such as \\d or
+    \\x41, groups, quantified characters). An unescaped trailing `$`
+    becomes END.
+    """
+    tokens, groups, i = [], [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            nxt = pattern[i + 1]
+            if nxt.isalnum():
+                tokens.append(None)
+                i = escape_end(pattern, i)
+            else:
+                tokens.append(nxt)
+                i += 2
+            continue
+        if c == '[':
+            end = pattern.find(']', i + 2)
+            tokens.append(None)
+            i = len(pattern) if end == -1 else end + 1
+            continue
+        if c == '(':
+            groups.append(len(tokens))
+            tokens.append(None)
+        elif c == ')':
+            start = groups.pop() if groups else 0
+            tokens.append(None)
+            if i + 1 < len(pattern) and pattern[i + 1] in OPTIONAL:
+                # an optional group doesn't require any of its characters
+                tokens[start:] = [None] * (len(tokens) - start)
+        elif c in OPTIONAL:
+            if tokens:
+                tokens[-1] = None
+            tokens.append(None)
+            if c == '{':
+                end = pattern.find('}', i)
+                i = len(pattern) if end == -1 else end
+        elif c == '+':
+            tokens.append(None)     # a repeated character ends a literal run
+        elif c == '$' and i == len(pattern) - 1:
+            tokens.append(END)
+        elif c in '.^$|':
+            tokens.append(None)
+        else:
+            tokens.append(c)
+        i += 1
+    return tokens
+
+
+def is_plain(pattern):
+    """
+    Alternations, inline flags (e.g. `(?i)`) and quoting (`\\Q...\\E`)
+    defeat literal analysis
+    """
+    return '|' not in pattern and '(?' not in pattern and \
+        '\\Q' not in pattern
+
+
+def literal(token):
+    return token is not None and token is not END
+
+
+def successor(prefix):
+    """Smallest string greater than all strings starting with prefix"""
+    last = ord(prefix[-1])
+    if last >= 0x10FFFF:
+        return None
+    return prefix[:-1] + chr(last + 1)
+
+
+def prefix_filter(pattern):
+    """
+    Rewrite an anchored regex with a literal prefix into an index-friendly
+    filter: an equality for `^literal$`, a range for `^prefix` and a range
+    narrowing the $regex otherwise. Returns None if there's no prefix.
+    """
+    if not pattern.startswith('^') or not is_plain(pattern):
+        return None
+    tokens = tokenize(pattern[1:])
+    prefix = ''.join(takewhile(literal, tokens))
+    if not prefix:
+        return None
+    rest = tokens[len(prefix):]
+    if rest == [END]:
+        return prefix
+    bounds = {"$gte": prefix}
+    upper = successor(prefix)
+    if upper is not None:
+        bounds["$lt"] = upper
+    if rest:
+        bounds["$regex"] = pattern
+    return bounds
+
+
+def required_trigrams(pattern):
+    """Trigrams that any string matching the regex must contain"""
+    if not is_plain(pattern):
+        return set()
+    grams, run = set(), ''
+    for token in tokenize(pattern) + [None]:
+        if literal(token):
+            run += token
+            continue
+        grams.update(run[i:i + 3] for i in range(len(run) - 2))
+        run = ''
+    return grams
+
+
+def string_trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class TrigramIndex(object):
+    """
+    Local index of the distinct values of text fields (e.g. `query`) per
+    project, with the trigrams of each value, stored in a sqlite database.
+
+    An unanchored regex is answered by looking up the values containing all
+    its required trigrams and verifying them against the regex, giving the
+    exact list of matching values. Values written after the index was built
+    aren't in it, so the index records the latest `timestamp` at build time
+    and callers must still regex-match the annotations from then on.
+
+    :param path: sqlite file, defaults to an in-memory database.
+    """
+    def __init__(self, path=':memory:'):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.matches = {}       # (field, pattern) -> matching values
+
+    def build(self, coll, project_name, field):
+        """(Re)index the values of a field in a project collection"""
+        latest = coll.find_one({}, projection={'timestamp': 1},
+                               sort=[('timestamp', -1)])
+        built_at = (latest or {}).get('timestamp') or 0
+        cursor = coll.aggregate(
+            [{"$match": {field: {"$type": "string"}}},
+             {"$group": {"_id": "$" + field}}])
+        values = [row['_id'] for row in cursor]
+        with self.lock, self.db:
+            self._drop(project_name, field)
+            self.db.executemany(
+                "INSERT INTO terms VALUES (?, ?, ?)",
+                ((project_name, field, value) for value in values))
+            self.db.executemany(
+                "INSERT INTO grams VALUES (?, ?, ?, ?)",
+                ((project_name, field, gram, value) for value in values
+                 for gram in string_trigrams(value)))
+            self.db.execute("INSERT INTO builds VALUES (?, ?, ?, ?)",
+                            (project_name, field, built_at, len(values)))
+            self.matches = {}
+        return len(values)
+
+    def _drop(self, project_name, field=None):
+        for table in ('terms', 'grams', 'builds'):
+            sql = "DELETE FROM %s WHERE project = ?" % table
+            params = (project_name,)
+            if field is not None:
+                sql, params = sql + " AND field = ?", params + (field,)
+            self.db.execute(sql, params)
+
+    def drop(self, project_name):
+        with self.lock, self.db:
+            self._drop(project_name)
+            self.matches = {}
+
+    def status(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT project, field, built_at, terms FROM builds "
+                "ORDER BY project, field").fetchall()
+        return [{'project': p, 'field': f, 'built_at': t, 'values': n}
+                for (p, f, t, n) in rows]
+
+    def built_at(self, field, project_names):
+        """
+        Oldest build timestamp of a field over the given projects, or None
+        if one of them isn't indexed.
+        """
+        project_names = set(project_names)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT project, built_at FROM builds WHERE field = ?",
+                (field,)).fetchall()
+        built = {project: built_at for (project, built_at) in rows}
+        if not project_names or not project_names <= set(built):
+            return None
+        return min(built[project] for project in project_names)
+
+    def candidates(self, field, pattern):
+        """
+        Indexed values of a field matching the regex, or None if the regex
+        isn't supported locally or matches too many values.
+        """
+        key = (field, pattern)
+        if key in self.matches:
+            return self.matches[key]
+        try:
+            regex = re.compile(pattern)
+        except re.error:
+            return None
+        grams = sorted(required_trigrams(pattern))
+        with self.lock:
+            if grams:
+                rows = self.db.execute(
+                    "SELECT value FROM grams WHERE field = ? AND gram IN "
+                    "({grams}) GROUP BY value "
+                    "HAVING COUNT(DISTINCT gram) = ?".format(
+                        grams=", ".join("?" * len(grams))),
+                    [field] + grams + [len(grams)]).fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT DISTINCT value FROM terms WHERE field = ?",
+                    (field,)).fetchall()
+        values = sorted(value for (value,) in rows if regex.search(value))
+        if len(values) > MAX_CANDIDATES:
+            values = None
+        self.matches[key] = values
+        return values
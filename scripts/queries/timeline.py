@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+__all__ = (
+    'UNITS',
+    'bucket_expr',
+    'format_bucket',
+    'series'
+)
+
+# Bucket granularities -> strftime format of the bucket labels
+UNITS = {'hour': '%Y-%m-%d %H:00',
+         'day': '%Y-%m-%d',
+         'week': '%Y-%m-%d',
+         'month': '%Y-%m',
+         'year': '%Y'}
+
+# Timestamps are milliseconds since the epoch, adding them to it gives dates
+EPOCH = datetime(1970, 1, 1)
+
+# Fixed-length steps between consecutive buckets
+STEPS = {'hour': timedelta(hours=1),
+         'day': timedelta(days=1),
+         'week': timedelta(weeks=1)}
+
+
+def bucket_expr(unit, server_version, field='timestamp'):
+    """
+    Aggregation expression truncating a millisecond timestamp field to the
+    start of its bucket (weeks start on Monday). Uses $dateTrunc on MongoDB
+    5.0 and rebuilds the date from its parts ($dateFromParts) before that.
+    """
+    assert unit in UNITS, "Specify one of {units}".format(units=tuple(UNITS))
+    date = {"$add": [EPOCH, "$" + field]}
+    if server_version >= (5, 0):
+        trunc = {"date": date, "unit": unit}
+        if unit == 'week':
+            trunc['startOfWeek'] = 'monday'
+        return {"$dateTrunc": trunc}
+    if unit == 'week':
+        return {"$dateFromParts": {"isoWeekYear": {"$isoWeekYear": date},
+                                   "isoWeek": {"$isoWeek": date}}}
+    parts = {"year": {"$year": date}}
+    for part in ('month', 'day', 'hour'):
+        if unit == 'year':
+            break
+        parts[part] = {"$" + ('dayOfMonth' if part == 'day' else part): date}
+        if part == unit:
+            break
+    return {"$dateFromParts": parts}
+
+
+def format_bucket(date, unit):
+    return date.strftime(UNITS[unit])
+
+
+def next_bucket(date, unit):
+    if unit == 'year':
+        return date.replace(year=date.year + 1)
+    if unit == 'month':
+        return date.replace(year=date.year + date.month // 12,
+                            month=date.month % 12 + 1)
+    return date + STEPS[unit]
+
+
+def series(rows, unit, groupkeys):
+    """
+    Turn (bucket, groupkeys, count) rows into one series per combination of
+    groupby keys: a dict from key values (a tuple) to the first and last
+    bucket of the timeline and the counts of all buckets in between,
+    filling buckets without annotations with 0.
+    """
+    rows = [row for row in rows if row['bucket'] is not None]
+    if not rows:
+        return {}
+    first = min(row['bucket'] for row in rows)
+    last = max(row['bucket'] for row in rows)
+    buckets, date = [], first
+    while date <= last:
+        buckets.append(date)
+        date = next_bucket(date, unit)
+    positions = {date: i for i, date in enumerate(buckets)}
+    by_keys = {}
+    for row in rows:
+        keys = tuple(row.get(k) for k in groupkeys)
+        counts = by_keys.setdefault(keys, [0] * len(buckets))
+        counts[positions[row['bucket']]] += row['count']
+    return {keys: (first, last, counts) for keys, counts in sorted(
+        by_keys.items(), key=lambda item: -sum(item[1]))}
@@ -0,0 +1,142 @@
+import re
+import time
+from collections import Counter, deque
+
+import pymongo
+
+import writers
+
+__all__ = (
+    'WindowCounter',
+    'change_stream',
+    'matcher',
+    'poll_changes'
+)
+
+# Fields whose values are counted in the sliding window
+WATCH_FIELDS = ('username', 'corpus', 'ann.key')
+
+# Error code of change streams on a standalone server
+NO_CHANGE_STREAMS = 40573
+
+
+def matcher(filters):
+    """
+    Predicate on annotations equivalent to the session filters (a dict
+    from field to values, `/regex/` values as in `Finder.query_filters`),
+    so that changes can be filtered on the client.
+    """
+    tests = []
+    for key, values in filters.items():
+        is_regex = len(values) == 1 and re.match(r"/([^/]+)/", values[0])
+        if is_regex:
+            regex = re.compile(is_regex.groups()[0])
+            tests.append((key, lambda v, regex=regex:
+                          isinstance(v, str) and regex.search(v) is not None))
+        else:
+            tests.append((key, lambda v, values=set(values):
+                          str(v) in values))
+
+    def match(doc):
+        return all(test(writers.get_in(doc, key)) for key, test in tests)
+    return match
+
+
+class WindowCounter(object):
+    """
+    Annotation counts per value of some fields over the last `window`
+    seconds, kept in one-second buckets: adding and expiring are O(1) per
+    annotation and field, whatever the rate.
+
+    :param window: width of the window in seconds.
+    :param fields: fields whose values are counted.
+    """
+    def __init__(self, window=60, fields=WATCH_FIELDS):
+        self.window = window
+        self.fields = fields
+        self.buckets = deque()      # (second, Counter of (field, value))
+        self.counts = Counter()
+        self.total = 0              # since the counter was created
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            _, bucket = self.buckets.popleft()
+            self.counts.subtract(bucket)
+        self.counts += Counter()    # drop zero counts
+
+    def add(self, doc, now=None):
+        second = int(now if now is not None else time.time())
+        if not self.buckets or self.buckets[-1][0] != second:
+            self.buckets.append((second, Counter()))
+        bucket = self.buckets[-1][1]
+        for key in (None,) + tuple(self.fields):
+            value = None if key is None else writers.get_in(doc, key)
+            bucket[(key, value)] += 1
+            self.counts[(key, value)] += 1
+        self.total += 1
+
+    def rows(self, now=None, top=5):
+        """The window total and the `top` values of each field, per minute"""
+        self.expire(int(now if now is not None else time.time()))
+        per_minute = 60.0 / self.window
+
+        def row(key, value, count):
+            return {'field': key or 'all', 'value': value or '',
+                    'count': count, 'per_min': round(count * per_minute, 1)}
+        rows = [row(None, None, self.counts[(None, None)])]
+        for field in self.fields:
+            values = [(value, count) for (key, value), count
+                      in self.counts.items() if key == field]
+            values.sort(key=lambda vc: -vc[1])
+            rows.extend(row(field, value, count)
+                        for value, count in values[:top])
+        return rows
+
+
+def change_stream(db, coll_names, timeout):
+    """
+    Changed annotations (inserts, updates, replacements) of the given
+    collections from a database change stream, or None every `timeout`
+    seconds without changes. Raises OperationFailure on servers without
+    change streams (standalone).
+    """
+    pipeline = [{"$match": {
+        "operationType": {"$in": ["insert", "update", "replace"]},
+        "ns.coll": {"$in": list(coll_names)}}}]
+    with db.watch(pipeline, full_document='updateLookup',
+                  max_await_time_ms=int(timeout * 1000)) as stream:
+        while stream.alive:
+            change = stream.try_next()
+            yield None if change is None else change.get('fullDocument')
+
+
+def poll_changes(colls, interval, sleep=time.sleep):
+    """
+    Changed annotations of the given collections found by polling them
+    every `interval` seconds for a `timestamp` at or after the last one
+    seen (inserts and updates both set it), or None after each poll.
+    Annotations already seen at the last timestamp are skipped.
+    """
+    last = {}
+    for coll in colls:
+        newest = list(coll.find(
+            {}, projection={'timestamp': 1, '_version': 1},
+            sort=[('timestamp', pymongo.DESCENDING)], limit=1))
+        last[coll.name] = (newest[0].get('timestamp') if newest else 0,
+                           {(doc['_id'], doc.get('_version'))
+                            for doc in newest})
+    while True:
+        sleep(interval)
+        for coll in colls:
+            since, seen = last[coll.name]
+            for doc in coll.find({'timestamp': {'$gte': since}},
+                                 sort=[('timestamp', pymongo.ASCENDING)]):
+                key = (doc['_id'], doc.get('_version'))
+                if doc['timestamp'] == since and key in seen:
+                    continue
+                if doc['timestamp'] > since:
+                    since, seen = doc['timestamp'], set()
+                seen.add(key)
+                yield doc
+            last[coll.name] = (since, seen)
+        yield None
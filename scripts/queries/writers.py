@@ -1,9 +1,35 @@
 
 import csv
+import sys
+import time
+import gzip
+import json
+from itertools import islice
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 def header_from_results(results):
-    return list(results[0].keys())
+    """Union of the keys of all results in order of appearance"""
+    header = []
+    for row in results:
+        for key in row:
+            if key not in header:
+                header.append(key)
+    return header
+
+
+def get_in(doc, key):
+    """Get the value of a dotted key (e.g. `ann.key`) in a nested document"""
+    for k in key.split('.'):
+        if not isinstance(doc, dict) or k not in doc:
+            return None
+        doc = doc[k]
+    return doc
 
 
 # String-formatters for stdout output
@@ -14,22 +40,26 @@ def _print_count(counts, project_name):
     print(count_text.format(counts=counts, project=project_name))
 
 
-def _print_count_group(counts, project_name):
-    print(project_name)
-    if len(counts) == 0:  # output might be empty
+def print_table(rows, title):
+    print(title)
+    if len(rows) == 0:  # output might be empty
         print()
         return
     print("---")
-    header = header_from_results(counts)
+    header = header_from_results(rows)
     maxlen = max([len(k) for k in header]) + 5
     padstr = '%-' + str(maxlen) + 's'
     print(padstr * len(header) % tuple(header))
-    for line in counts:
-        vals = [line[k] for k in header]
+    for line in rows:
+        vals = [line.get(k) for k in header]
         print(padstr * len(header) % tuple(vals))
     print()
 
 
+def _print_count_group(counts, project_name):
+    print_table(counts, project_name)
+
+
 def print_count(by_project):
     for project_name, counts in by_project.items():
         _print_count(counts, project_name)
@@ -40,30 +70,218 @@ def print_count_group(by_project):
         _print_count_group(counts, project_name)
 
 
-# CSV writers
-
-
-def csv_count(by_project, outfile):
-    results = [{'count': c, 'project': p} for p, c in by_project.items()]
-    header = header_from_results(results)
-    with open(outfile, 'w', newline='') as f:
-        csvwriter = csv.DictWriter(f, delimiter=',', fieldnames=header)
-        # write header
-        csvwriter.writerow({field: field for field in header})
-        # write rows
-        for row in results:
-            csvwriter.writerow(row)
-
-
-def csv_count_group(by_project, outfile):
-    results = [dict(row, project=p)
-               for p, counts in by_project.items()
-               for row in counts]
-    header = header_from_results(results)
-    with open(outfile, 'w', newline='') as f:
-        csvwriter = csv.DictWriter(f, delimiter=',', fieldnames=header)
-        # write header
-        csvwriter.writerow({field: field for field in header})
-        # write rows
-        for row in results:
-            csvwriter.writerow({field: row[field] for field in header})
+def print_histogram(counts, title, width=40):
+    """Print (upper bound, count) pairs as horizontal bars"""
+    print(title)
+    print("---")
+    total = max([c for _, c in counts] + [1])
+    for upper, count in counts:
+        bar = '#' * int(width * count / total)
+        print('< %-8s %-6d %s' % (upper, count, bar))
+    print()
+
+
+# Bar heights of sparklines, from empty to full
+SPARKS = ' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+
+def sparkline(values, width=60):
+    """Render values as a line of bars, summing neighbours beyond `width`"""
+    step = -(-len(values) // width)     # ceiling division
+    values = [sum(values[i:i + step]) for i in range(0, len(values), step)]
+    top = max(values + [1])
+    return ''.join(SPARKS[int(round((len(SPARKS) - 1) * v / top))]
+                   for v in values)
+
+
+def print_timeline(by_project, title):
+    """
+    Print a sparkline per series of a timeline. `by_project` maps project
+    names to lists of (label, first, last, counts) series.
+    """
+    print(title)
+    print("---")
+    for project_name, lines in by_project.items():
+        print(project_name)
+        for label, first, last, counts in lines:
+            print("  {label:24} {first} {spark} {last}  total={total} "
+                  "max={top}".format(label=label, first=first, last=last,
+                                     spark=sparkline(counts),
+                                     total=sum(counts), top=max(counts)))
+    print()
+
+
+def print_watch(rows, title, redraw=True):
+    """Print the `watch` table, with `redraw` in place on terminals"""
+    if redraw and sys.stdout.isatty():
+        print("\033[H\033[J", end='')
+    print_table(rows, "{title} ({time})".format(
+        title=title, time=time.strftime('%H:%M:%S')))
+
+
+def print_annotations(docs, fields, title):
+    print_table([{f: get_in(doc, f) for f in fields} for doc in docs], title)
+
+
+def print_strategies(strategies):
+    by_strategy = {}
+    for project_name, strategy in strategies.items():
+        by_strategy.setdefault(strategy, []).append(project_name)
+    for strategy, project_names in by_strategy.items():
+        print("Counted [{n}] project(s) using [{strategy}] strategy".format(
+            n=len(project_names), strategy=strategy))
+
+
+def print_failed(failed):
+    for project_name, error in failed.items():
+        print("Failed project [{project}]: {error}".format(
+            project=project_name, error=error))
+
+
+# Streaming writers. Rows are dicts from field name to value, passed as an
+# iterator so that they can be written straight from a pymongo cursor.
+# The header must be known in advance (e.g. from the groupby keys).
+# The `*_tuples` writers take rows as tuples of values in header order,
+# which spares building a dict per row on bulk exports.
+
+
+def open_output(outfile, compress=False):
+    if compress:
+        return gzip.open(outfile, 'wt', newline='')
+    return open(outfile, 'w', newline='')
+
+
+def as_tuples(rows, header):
+    for row in rows:
+        yield tuple(row.get(field) for field in header)
+
+
+def csv_tuples(rows, header, outfile, compress=False):
+    with open_output(outfile, compress=compress) as f:
+        csvwriter = csv.writer(f, delimiter=',')
+        csvwriter.writerow(header)
+        csvwriter.writerows(rows)
+
+
+def jsonl_tuples(rows, header, outfile, compress=False):
+    with open_output(outfile, compress=compress) as f:
+        for row in rows:
+            f.write(json.dumps(dict(zip(header, row)), default=str))
+            f.write('\n')
+
+
+def stringify(value):
+    """Value of a column of mixed types, as written to Parquet"""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def string_array(values):
+    return pyarrow.array([stringify(v) for v in values], type=pyarrow.string())
+
+
+def column_array(values):
+    """
+    Arrow array of a column. Columns whose values don't share a type (e.g.
+    `hit-id`, of any type in the schema) are converted to strings.
+    """
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+        return string_array(values)
+
+
+def parquet_tuples(rows, header, outfile, compress=False, chunk_size=10000):
+    if pyarrow is None:
+        raise ValueError("Parquet output requires pyarrow")
+    compression = 'gzip' if compress else 'snappy'
+    rows, writer, types = iter(rows), None, None
+    try:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            columns = list(zip(*chunk))
+            arrays = [column_array(column) for column in columns]
+            if types is None:
+                # columns without values in the first chunk default to string
+                types = [pyarrow.string() if pyarrow.types.is_null(a.type)
+                         else a.type for a in arrays]
+            changed = []
+            for i, array in enumerate(arrays):
+                if array.type == types[i] or \
+                   pyarrow.types.is_null(array.type):
+                    continue
+                # values of another type than in the earlier chunks
+                arrays[i] = string_array(columns[i])
+                if types[i] != pyarrow.string():
+                    changed.append(i)
+            written = None
+            if writer is not None and changed:
+                # rewrite the file with the changed columns as strings
+                writer.close()
+                written = pyarrow.parquet.read_table(outfile)
+                for i in changed:
+                    written = written.set_column(
+                        i, header[i], string_array(written[i].to_pylist()))
+                writer = None
+            for i in changed:
+                types[i] = pyarrow.string()
+            if writer is None:
+                schema = pyarrow.schema(list(zip(header, types)))
+                writer = pyarrow.parquet.ParquetWriter(
+                    outfile, schema, compression=compression)
+                if written is not None:
+                    writer.write_table(written)
+            writer.write_table(pyarrow.Table.from_arrays(
+                [a.cast(t) for a, t in zip(arrays, types)],
+                schema=writer.schema))
+        if writer is None:      # no rows, write the header only
+            pyarrow.parquet.write_table(
+                pyarrow.schema([(field, pyarrow.string())
+                                for field in header]).empty_table(),
+                outfile, compression=compression)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+TUPLE_WRITERS = {'csv': csv_tuples, 'jsonl': jsonl_tuples,
+                 'parquet': parquet_tuples}
+
+
+def write_tuples(rows, header, outfile, fmt, compress=False):
+    if fmt not in TUPLE_WRITERS:
+        raise ValueError("Unrecognized extension [%s]" % fmt)
+    TUPLE_WRITERS[fmt](rows, header, outfile, compress=compress)
+
+
+def write_rows(rows, header, outfile, fmt, compress=False):
+    write_tuples(as_tuples(rows, header), header, outfile, fmt,
+                 compress=compress)
+
+
+def count_rows(by_project):
+    for p, c in by_project.items():
+        yield {'count': c, 'project': p}
+
+
+def count_group_rows(by_project):
+    for p, counts in by_project.items():
+        for row in counts:
+            yield dict(row, project=p)
+
+
+def write_count(by_project, outfile, fmt='csv', compress=False):
+    write_rows(count_rows(by_project), ['count', 'project'], outfile, fmt,
+               compress=compress)
+
+
+def write_count_group(by_project, groupkeys, outfile, fmt='csv',
+                      compress=False):
+    header = ['count'] + list(groupkeys) + ['project']
+    write_rows(count_group_rows(by_project), header, outfile, fmt,
+               compress=compress)